@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Compare the speed of reading annotation files with the streaming parser
+and with the eval-based parser it replaced.
+
+Usage: python benchmarks/annotation_parser.py [-n LINES] [-r REPEATS]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slate import data, fileformat
+from slate.config import Config
+
+def eval_read_annotation_file(config, filename, doc):
+    """The parser as it was before slate.fileformat, kept for comparison."""
+    def get_spans(text):
+        spans = []
+        if text[0] in '[(':
+            spans = eval(text.strip())
+            if type(spans) == int:
+                spans = [(spans,)]
+            elif type(spans) == tuple:
+                spans = [spans]
+            elif type(spans) == list:
+                if len(spans) == 0:
+                    spans = [()]
+                elif type(spans[0]) == int:
+                    spans = [(s,) for s in spans]
+        else:
+            for num in text.split():
+                spans.append((int(num),))
+        return [data.Span(config.annotation, doc, s) for s in spans]
+
+    items = []
+    for line in open(filename):
+        spans = get_spans(line.split('-')[0])
+        labels = data.get_labels('-'.join(line.split('-')[1:]), config)
+        items.append(data.Item(doc, spans, labels))
+    return items
+
+def eval_parse_lines(filename):
+    """Only the span parsing step of the eval-based reader."""
+    for line in open(filename):
+        text = line.split('-')[0]
+        if text[0] in '[(':
+            spans = eval(text.strip())
+        else:
+            spans = [(int(num),) for num in text.split()]
+        yield spans, '-'.join(line.split('-')[1:]).split()
+
+def make_corpus(directory, num_lines, rnd):
+    """Write a document and token-level annotations covering it."""
+    doc_file = os.path.join(directory, 'doc.txt')
+    ann_file = os.path.join(directory, 'doc.txt.annotations')
+    lengths = []
+    with open(doc_file, 'w') as out:
+        for _ in range(max(1, num_lines // 2)):
+            length = rnd.randint(3, 20)
+            lengths.append(length)
+            print(' '.join('w{}'.format(rnd.randint(0, 999)) for _ in range(length)), file=out)
+    labels = ['label:a', 'label:s', 'label:d']
+    with open(ann_file, 'w') as out:
+        for _ in range(num_lines):
+            line = rnd.randrange(len(lengths))
+            start = rnd.randrange(lengths[line])
+            end = rnd.randrange(start, lengths[line])
+            if start == end:
+                span = str((line, start))
+            else:
+                span = str(((line, start), (line, end)))
+            print(span, '-', ' '.join(rnd.sample(labels, rnd.randint(1, 2))), file=out)
+    return doc_file, ann_file
+
+def time_reader(reader, config, filename, doc, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        items = reader(config, filename, doc)
+        taken = time.perf_counter() - start
+        if best is None or taken < best:
+            best = taken
+    return best, items
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark annotation file parsing.')
+    parser.add_argument('-n', '--lines', default=200000, type=int, help='Number of annotations to generate.')
+    parser.add_argument('-r', '--repeats', default=3, type=int, help='Number of timed runs (the best is reported).')
+    args = parser.parse_args()
+
+    ann_args = argparse.Namespace(ann_type='categorical', ann_scope='token',
+            config_file=None, lazy_load=False)
+    config = Config(ann_args)
+
+    directory = tempfile.mkdtemp()
+    try:
+        doc_file, ann_file = make_corpus(directory, args.lines, random.Random(0))
+        doc = data.Document(doc_file)
+        for name, parse in [
+            ('eval', eval_parse_lines),
+            ('stream', fileformat.iter_annotation_lines),
+        ]:
+            start = time.perf_counter()
+            for _ in parse(ann_file):
+                pass
+            taken = time.perf_counter() - start
+            print("parse only {:<8} {:>10.0f} lines/sec".format(name, args.lines / taken))
+
+        results = []
+        for name, reader in [
+            ('eval', eval_read_annotation_file),
+            ('stream', data.read_annotation_file),
+        ]:
+            taken, items = time_reader(reader, config, ann_file, doc, args.repeats)
+            results.append((name, taken, [str(item) for item in items]))
+    finally:
+        shutil.rmtree(directory)
+
+    assert results[0][2] == results[1][2], "Parsers disagree"
+    for name, taken, _ in results:
+        print("read file  {:<8} {:>10.0f} lines/sec  ({:.2f}s for {} lines)".format(
+            name, args.lines / taken, taken, args.lines))
+    print("Speedup: {:.1f}x".format(results[0][1] / results[1][1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Time the main steps of the data layer on generated corpora, reporting
+throughput and peak memory as JSON.
+
+Each corpus is a document of random tokens, an annotation file, and some
+comparison files that mostly agree with it. The steps timed are reading the
+document, reading the annotations, setting up a Datum (with the comparison
+files and the disagreements between them), getting the markings for the
+screen, changing annotations, searching, and writing annotations out. Each
+is run several times and the fastest is reported. Peak memory is the most
+allocated at once during one more run, under tracemalloc.
+
+Usage: python benchmarks/data_layer.py [-n LINES ...] [-a DENSITY ...]
+           [-c FILES ...] [-r REPEATS] [-o OUTPUT]
+
+For example, to compare against a saved run before upgrading:
+    python benchmarks/data_layer.py -n 10000 100000 1000000 -c 1 10 -o new.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slate import data
+from slate.config import Config
+
+LABELS = {
+    'label:a': (('SPACE', 'a'), 'green'),
+    'label:s': (('SPACE', 's'), 'blue'),
+    'label:d': (('SPACE', 'd'), 'magenta'),
+    'label:v': (('SPACE', 'v'), 'red'),
+}
+
+# Annotations per line of text
+DENSITIES = {
+    'sparse': 0.1,
+    'dense': 2.0,
+}
+
+# The share of a comparison file's annotations that differ from the main file
+COMPARISON_NOISE = 0.1
+
+# Operations in the steps that are counted by operation
+NUM_EDITS = 2000
+NUM_MARKINGS = 200
+NUM_QUERIES = 100
+
+def random_span(lengths, rnd):
+    line = rnd.randrange(len(lengths))
+    while lengths[line] == 0:
+        line = rnd.randrange(len(lengths))
+    start = rnd.randrange(lengths[line])
+    end = min(lengths[line] - 1, start + rnd.choice([0, 0, 0, 1, 2]))
+    return ((line, start), (line, end))
+
+def format_span(span):
+    if span[0] == span[1]:
+        return str(span[0])
+    return str(span)
+
+def make_corpus(directory, num_lines, density, num_compare, rnd):
+    """Write a document, its annotations and comparison annotations.
+    Returns the filenames and the number of tokens on each line."""
+    doc_file = os.path.join(directory, 'doc.txt')
+    lengths = []
+    with open(doc_file, 'w') as out:
+        for _ in range(num_lines):
+            # Some blank lines, as in real text
+            length = 0 if rnd.random() < 0.05 else rnd.randint(3, 20)
+            lengths.append(length)
+            print(' '.join('w{}'.format(rnd.randint(0, 9999)) for _ in range(length)), file=out)
+
+    labels = sorted(LABELS)
+    num_annotations = int(num_lines * DENSITIES[density])
+    annotations = {}
+    while len(annotations) < num_annotations:
+        annotations[random_span(lengths, rnd)] = rnd.choice(labels)
+
+    ann_file = os.path.join(directory, 'doc.txt.annotations')
+    with open(ann_file, 'w') as out:
+        for span, label in annotations.items():
+            print(format_span(span), '-', label, file=out)
+
+    compare_files = []
+    spans = sorted(annotations)
+    for num in range(num_compare):
+        filename = os.path.join(directory, 'doc.txt.compare{}'.format(num))
+        with open(filename, 'w') as out:
+            for span in spans:
+                if rnd.random() < COMPARISON_NOISE:
+                    change = rnd.randrange(3)
+                    if change == 0:
+                        # Left out
+                        continue
+                    elif change == 1:
+                        # Labelled differently
+                        print(format_span(span), '-', rnd.choice(labels), file=out)
+                        continue
+                    else:
+                        # An extra annotation
+                        print(format_span(random_span(lengths, rnd)), '-', annotations[span], file=out)
+                print(format_span(span), '-', annotations[span], file=out)
+        compare_files.append(filename)
+
+    return doc_file, ann_file, compare_files, lengths, len(annotations)
+
+def measure(run, setup=None, repeats=3, memory=True):
+    """The fastest time for run(setup()), and the peak bytes allocated during
+    one more run. Only run is timed."""
+    best = None
+    for _ in range(repeats):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        run(arg)
+        taken = time.perf_counter() - start
+        if best is None or taken < best:
+            best = taken
+
+    peak = None
+    if memory:
+        arg = setup() if setup is not None else None
+        tracemalloc.start()
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+def benchmark_corpus(args, num_lines, density, num_compare, directory):
+    rnd = random.Random(0)
+    doc_file, ann_file, compare_files, lengths, num_annotations = make_corpus(
+            directory, num_lines, density, num_compare, rnd)
+    config = Config(argparse.Namespace(ann_type='categorical', ann_scope='token',
+        config_file=None, lazy_load=args.lazy_load, overwrite=True,
+        do_not_show_linked=False), dict(LABELS))
+    out_file = os.path.join(directory, 'out.annotations')
+
+    def new_doc(_=None):
+        return data.Document(doc_file, args.lazy_load)
+    def new_datum(_=None):
+        return data.Datum(doc_file, config, ann_file, compare_files, new_doc())
+    def cursor_spans(doc, count):
+        spans_rnd = random.Random(1)
+        return [data.Span('token', doc, random_span(lengths, spans_rnd)) for _ in range(count)]
+
+    def read_annotations(doc):
+        data.read_annotation_file(config, ann_file, doc)
+
+    def setup_datum(doc):
+        datum = data.Datum(doc_file, config, ann_file, compare_files, doc)
+        # Includes finding the spans annotators disagree on
+        datum.get_next_disagreement(data.Span('token', doc), None, 'next', False)
+
+    def first_markings(datum):
+        datum.get_all_markings(data.Span('token', datum.doc), None)
+
+    def setup_markings():
+        datum = new_datum()
+        datum.get_all_markings(data.Span('token', datum.doc), None)
+        return datum, cursor_spans(datum.doc, NUM_MARKINGS)
+    def markings(arg):
+        datum, cursors = arg
+        for cursor in cursors:
+            datum.get_all_markings(cursor, None)
+
+    def setup_edits():
+        datum = new_datum()
+        # With the marking layer in use, as it is while annotating
+        datum.get_all_markings(data.Span('token', datum.doc), None)
+        edit_rnd = random.Random(2)
+        labels = sorted(LABELS)
+        edits = [([data.Span('token', datum.doc, random_span(lengths, edit_rnd))], edit_rnd.choice(labels))
+                for _ in range(NUM_EDITS)]
+        return datum, edits
+    def edits(arg):
+        datum, edits = arg
+        for spans, label in edits:
+            datum.modify_annotation(spans, label)
+
+    query_rnd = random.Random(3)
+    queries = ['w{}'.format(query_rnd.randint(0, 9999)) for _ in range(NUM_QUERIES)]
+    def search(doc):
+        for query in queries:
+            doc.matches(query)
+
+    def write(datum):
+        datum.write_out(out_file)
+
+    stages = [
+        ('document', new_doc, None, num_lines, 'lines'),
+        ('read_annotation_file', read_annotations, new_doc, num_annotations, 'annotations'),
+        ('datum', setup_datum, new_doc, num_annotations * (1 + num_compare), 'annotations'),
+        ('get_all_markings_first', first_markings, new_datum, 1, 'calls'),
+        ('get_all_markings', markings, setup_markings, NUM_MARKINGS, 'calls'),
+        ('modify_annotation', edits, setup_edits, NUM_EDITS, 'edits'),
+        ('matches', search, new_doc, NUM_QUERIES, 'queries'),
+        ('write_out', write, new_datum, num_annotations, 'annotations'),
+    ]
+    results = []
+    for name, run, setup, count, unit in stages:
+        if args.stages is not None and name not in args.stages:
+            continue
+        taken, peak = measure(run, setup, args.repeats, not args.no_memory)
+        result = {
+            'lines': num_lines,
+            'density': density,
+            'comparison_files': num_compare,
+            'annotations': num_annotations,
+            'lazy_load': args.lazy_load,
+            'stage': name,
+            'seconds': taken,
+            'count': count,
+            'unit': unit,
+            'per_second': count / taken if taken > 0 else None,
+            'peak_memory_bytes': peak,
+        }
+        results.append(result)
+        print("{:>8} lines {:<6} {:>2} compare  {:<22} {:>12.0f} {}/sec".format(
+            num_lines, density, num_compare, name, result['per_second'] or 0, unit),
+            file=sys.stderr)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data layer on generated corpora.')
+    parser.add_argument('-n', '--lines', nargs='+', default=[10000, 100000], type=int,
+            help='Numbers of lines of text to generate (default: 10000 100000).')
+    parser.add_argument('-a', '--density', nargs='+', default=sorted(DENSITIES), choices=sorted(DENSITIES),
+            help='How many annotations to generate (default: all).')
+    parser.add_argument('-c', '--comparisons', nargs='+', default=[1], type=int,
+            help='Numbers of comparison files to generate (default: 1).')
+    parser.add_argument('-s', '--stages', nargs='+',
+            help='Only run these steps.')
+    parser.add_argument('-r', '--repeats', default=3, type=int,
+            help='Number of timed runs (the best is reported).')
+    parser.add_argument('--lazy-load', action='store_true',
+            help='Read documents as they would be with --lazy-load.')
+    parser.add_argument('--no-memory', action='store_true',
+            help='Do not measure peak memory (saves one run of each step).')
+    parser.add_argument('-o', '--output',
+            help='File to write JSON results to (default: standard output).')
+    args = parser.parse_args()
+
+    results = []
+    for num_lines in args.lines:
+        for density in args.density:
+            for num_compare in args.comparisons:
+                directory = tempfile.mkdtemp()
+                try:
+                    results += benchmark_corpus(args, num_lines, density, num_compare, directory)
+                finally:
+                    shutil.rmtree(directory)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeats': args.repeats,
+        'results': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""Replay a script of keystrokes through the annotation interface without a
+terminal and report how long each keypress takes to show on screen.
+
+The interface draws into FakeWindow, which keeps the screen contents in
+memory and hands out keys from the script. A keypress's latency is from
+when getch returns it to when the interface next waits for input, which
+covers applying the action and drawing the screen. Bursts of key repeats
+are handed out together, as a terminal would, and count as one press.
+
+Latency percentiles are reported for each kind of input (moving, moving
+with a key held down, labelling, searching and changing files) as JSON.
+
+Usage: python benchmarks/interface.py [-n LINES] [-f FILES] [-k ROUNDS]
+           [--height ROWS] [--width COLUMNS] [--pause SECONDS] [-o OUTPUT]
+"""
+
+from __future__ import print_function
+
+import argparse
+import curses
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slate import data
+from slate.annotate import Annotator
+from slate.config import Config
+
+LABELS = {
+    'label:a': (('SPACE', 'a'), 'green'),
+    'label:s': (('SPACE', 's'), 'blue'),
+    'label:d': (('SPACE', 'd'), 'magenta'),
+    'label:v': (('SPACE', 'v'), 'red'),
+}
+
+ENTER = 10
+
+def headless():
+    """Replace the curses functions that need a terminal. Colour pairs are
+    given the same attribute values curses would use."""
+    curses.use_default_colors = lambda: None
+    curses.init_pair = lambda num, fore, back: None
+    curses.curs_set = lambda visibility: None
+    curses.doupdate = lambda: None
+    curses.color_pair = lambda num: num << 8
+
+class FakeWindow(object):
+    """A stand-in for a curses window that records what is drawn and gives
+    out keys from a script of (kind, [key codes]) steps."""
+
+    def __init__(self, height, width, script, pause=0):
+        self.height = height
+        self.width = width
+        self.script = list(reversed(script))
+        self.pause = pause
+        self.blocking = True
+        self.pending = []
+        # The step whose keys were last given out, and when
+        self.current = None
+        self.current_time = None
+        self.latencies = {}
+        self.cells = None
+        self.cells_written = 0
+        self.refreshes = 0
+        self.clear()
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def clear(self):
+        self.cells = [[(' ', 0)] * self.width for _ in range(self.height)]
+
+    def erase(self):
+        self.clear()
+
+    def addstr(self, row, column, text, attr=0):
+        # As in curses, text wraps onto the next line and writing past the
+        # bottom right corner is an error (after writing it)
+        if not (0 <= row < self.height and 0 <= column < self.width):
+            raise curses.error("addstr() returned ERR")
+        for char in text:
+            self.cells[row][column] = (char, attr)
+            self.cells_written += 1
+            column += 1
+            if column == self.width:
+                column = 0
+                row += 1
+                if row == self.height:
+                    raise curses.error("addstr() returned ERR")
+
+    def refresh(self):
+        self.refreshes += 1
+
+    def noutrefresh(self):
+        self.refreshes += 1
+
+    def nodelay(self, flag):
+        self.blocking = not flag
+
+    def getch(self):
+        if not self.blocking:
+            return self.pending.pop() if len(self.pending) > 0 else -1
+
+        # Waiting for input means the last keys have been dealt with
+        now = time.perf_counter()
+        if self.current is not None:
+            self.latencies.setdefault(self.current, []).append(now - self.current_time)
+        if self.pause > 0:
+            time.sleep(self.pause)
+
+        self.current, keys = self.script.pop()
+        self.pending = list(reversed(keys))
+        self.current_time = time.perf_counter()
+        return self.pending.pop()
+
+    def text(self):
+        return '\n'.join(''.join(char for char, _ in row) for row in self.cells)
+
+def keys(text):
+    return [ENTER if char == '\n' else ord(char) for char in text]
+
+def make_script(rounds, num_files, rnd):
+    """Steps of (kind, key codes) that move around, label, search and change
+    files, then quit."""
+    script = []
+    for _ in range(rounds):
+        for _ in range(20):
+            script.append(('move', keys(rnd.choice('ioj;'))))
+        for _ in range(2):
+            script.append(('move-held', keys(rnd.choice('o;j') * 30)))
+        for _ in range(5):
+            script.append(('move', keys(rnd.choice(';o'))))
+            script.append(('label', keys(' ')))
+            script.append(('label', keys(rnd.choice('asdv'))))
+        query = 'w{}'.format(rnd.randint(0, 999))
+        for step in ['\\'] + list(query) + ['\n']:
+            script.append(('search', keys(step)))
+        for _ in range(5):
+            script.append(('search', keys(rnd.choice('nnp'))))
+        if num_files > 1:
+            script.append(('change-file', keys(rnd.choice('[]'))))
+    script.append(('quit', keys('Q')))
+    return script
+
+def make_files(directory, num_files, num_lines, rnd):
+    """Documents with dense annotations and a comparison file that mostly
+    agrees. Returns data list lines."""
+    file_info = []
+    for num in range(num_files):
+        doc_file = os.path.join(directory, 'doc{}.txt'.format(num))
+        lengths = []
+        with open(doc_file, 'w') as out:
+            for _ in range(num_lines):
+                length = rnd.randint(3, 20)
+                lengths.append(length)
+                print(' '.join('w{}'.format(rnd.randint(0, 999)) for _ in range(length)), file=out)
+        ann_file = doc_file + '.annotations'
+        compare_file = doc_file + '.compare'
+        labels = sorted(LABELS)
+        with open(ann_file, 'w') as out, open(compare_file, 'w') as compare:
+            for line, length in enumerate(lengths):
+                for token in rnd.sample(range(length), 2):
+                    label = rnd.choice(labels)
+                    print((line, token), '-', label, file=out)
+                    if rnd.random() < 0.1:
+                        label = rnd.choice(labels)
+                    print((line, token), '-', label, file=compare)
+        file_info.append(' '.join([doc_file, ann_file, '((0,0),(0,0))', compare_file]))
+    return file_info
+
+def percentile(values, fraction):
+    """Nearest rank percentile of sorted values."""
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark keypress latency in the interface, without a terminal.')
+    parser.add_argument('-n', '--lines', default=100000, type=int,
+            help='Lines of text in each generated file (default: 100000).')
+    parser.add_argument('-f', '--files', default=3, type=int,
+            help='Number of files to generate (default: 3).')
+    parser.add_argument('-k', '--rounds', default=20, type=int,
+            help='Number of times to go through the script of actions (default: 20).')
+    parser.add_argument('--height', default=50, type=int,
+            help='Rows in the window (default: 50).')
+    parser.add_argument('--width', default=200, type=int,
+            help='Columns in the window (default: 200).')
+    parser.add_argument('--pause', default=0, type=float,
+            help='Seconds to wait before each keypress, as a person typing would.')
+    parser.add_argument('--lazy-load', action='store_true',
+            help='Read documents as they would be with --lazy-load.')
+    parser.add_argument('-o', '--output',
+            help='File to write JSON results to (default: standard output).')
+    args = parser.parse_args()
+
+    headless()
+    rnd = random.Random(0)
+    directory = tempfile.mkdtemp()
+    try:
+        file_info = make_files(directory, args.files, args.lines, rnd)
+        logging.basicConfig(filename=os.path.join(directory, 'log'), level=logging.INFO)
+
+        # The options the interface would have by default
+        ann_args = argparse.Namespace(ann_type='categorical', ann_scope='token',
+                config_file=None, lazy_load=args.lazy_load, overwrite=True,
+                readonly=False, log_prefix=os.path.join(directory, 'log'),
+                cache_memory=200, search_regex=False, prevent_self_links=False,
+                prevent_forward_links=False, do_not_show_linked=False,
+                alternate_comparisons=False, show_help=False, show_legend=False,
+                show_progress=False, show_mark=False, profile=False)
+        config = Config(ann_args, dict(LABELS))
+        filenames = data.process_fileinfo(file_info, config)
+
+        window = FakeWindow(args.height, args.width,
+                make_script(args.rounds, args.files, rnd), args.pause)
+        annotator = Annotator(config, filenames, ['category'], ann_args)
+        start = time.perf_counter()
+        annotator.annotate(window)
+        taken = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+
+    results = {}
+    for kind, latencies in sorted(window.latencies.items()):
+        latencies.sort()
+        results[kind] = {
+            'presses': len(latencies),
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'max_ms': latencies[-1] * 1000,
+        }
+        print("{:<12} {:>5} presses  p50 {:>8.2f} ms  p99 {:>8.2f} ms".format(
+            kind, len(latencies), results[kind]['p50_ms'], results[kind]['p99_ms']),
+            file=sys.stderr)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'lines': args.lines,
+        'files': args.files,
+        'height': args.height,
+        'width': args.width,
+        'lazy_load': args.lazy_load,
+        'seconds': taken,
+        'cells_written': window.cells_written,
+        'refreshes': window.refreshes,
+        'latency': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Measure the bytes used per annotation and per marked position, which
+Datum.memory_size uses (ITEM_BYTES, INDEXED_ITEM_BYTES and
+MARKED_POSITION_BYTES in slate/data.py) to decide how many files fit in
+--cache-memory.
+
+Each is the memory still allocated after building the structure, under
+tracemalloc, divided by the number of annotations (or marked positions),
+on the corpora generated by data_layer.py.
+
+Usage: python benchmarks/item_sizes.py [-n LINES]
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from data_layer import DENSITIES, LABELS, make_corpus
+from slate import data
+from slate.config import Config
+
+def allocated(build):
+    """The result of build() and the bytes it left allocated."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory used per annotation.')
+    parser.add_argument('-n', '--lines', default=20000, type=int,
+            help='Lines of text to generate (default: 20000).')
+    args = parser.parse_args()
+
+    config = Config(argparse.Namespace(ann_type='categorical', ann_scope='token',
+        config_file=None, lazy_load=False, overwrite=True,
+        do_not_show_linked=False), dict(LABELS))
+    for density in sorted(DENSITIES):
+        directory = tempfile.mkdtemp()
+        try:
+            doc_file, ann_file, compare_files, _, _ = make_corpus(
+                    directory, args.lines, density, 1, random.Random(0))
+            doc = data.Document(doc_file, False)
+
+            items, size = allocated(lambda: data.read_annotation_file(config, ann_file, doc))
+            print("{:<6} ITEM_BYTES            {:>6.0f}".format(density, size / float(len(items))))
+            index, size = allocated(lambda: data.AnnotationIndex(doc,
+                data.read_annotation_file(config, ann_file, doc)))
+            print("{:<6} INDEXED_ITEM_BYTES    {:>6.0f}".format(density, size / float(len(index))))
+
+            datum = data.Datum(doc_file, config, ann_file, compare_files, doc)
+            layer, size = allocated(datum.get_marking_layer)
+            marks = len(layer.item_marks) + len(layer.disagreement_marks)
+            print("{:<6} MARKED_POSITION_BYTES {:>6.0f}".format(density, size / float(marks)))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+from __future__ import print_function
+
+import bisect
+
+def item_key(item):
+    """A canonical form of an item, with its spans and labels sorted, so that
+    equal items always have the same key. Each span is flattened into one
+    tuple (start + end), which sorts the same way and hashes faster."""
+    spans = item.spans
+    if len(spans) == 1:
+        spans = (spans[0].start + spans[0].end,)
+    else:
+        spans = tuple(sorted([span.start + span.end for span in spans]))
+    labels = item.labels
+    if len(labels) == 1:
+        labels = tuple(labels)
+    else:
+        labels = tuple(sorted([str(label) for label in labels]))
+    return (spans, labels)
+
+def span_key(span):
+    return (span.start, span.end)
+
+class Adjudication(object):
+    """How far several annotators agree on each item of one document.
+
+    Items are counted by item_key, once per annotator, and then put in order
+    with a single sort of the distinct items. The first time a disagreement
+    is looked for, spans are indexed in document order, so that finding the
+    next or previous one is a binary search."""
+
+    def __init__(self, annotation_sets):
+        self.num_sets = len(annotation_sets)
+
+        self.counts = {}
+        latest = {}
+        for items in annotation_sets:
+            unique = {item_key(item): item for item in items}
+            latest.update(unique)
+            for key in unique:
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+        # (key, item, number of annotators with it), sorted by key
+        self.items = [(key, latest[key], self.counts[key]) for key in sorted(self.counts)]
+
+        # (item, number of annotators without it)
+        self.disagreements = [(item, self.num_sets - count) for _, item, count in self.items]
+
+        # Span objects for each (start, end) key, set by _build_index
+        self.spans = None
+
+    def _build_index(self):
+        self.spans = {}
+        # The last span of each item not everyone has, for moving a link
+        last_spans = set()
+        # Every span of an item not everyone has
+        disputed_spans = set()
+        # span -> spans up to it, in items that include it
+        linked = {}
+        for _, item, count in self.items:
+            keys = []
+            for span in item.spans:
+                key = (span.start, span.end)
+                self.spans[key] = span
+                keys.append(key)
+            if count < self.num_sets:
+                last_spans.add(max(keys))
+                disputed_spans.update(keys)
+            for key in keys:
+                others = linked.get(key)
+                if others is None:
+                    others = linked[key] = set()
+                others.update([other for other in keys if other <= key])
+        self.last_spans = sorted(last_spans)
+        self.disputed_spans = sorted(disputed_spans)
+        self.linked = {key: sorted(others) for key, others in linked.items()}
+
+    def __len__(self):
+        return len(self.items)
+
+    def agreement(self, item):
+        """The number of annotators who have this item."""
+        return self.counts.get(item_key(item), 0)
+
+    def _step(self, keys, pos, direction, cycle):
+        if len(keys) == 0:
+            return None
+        if direction == 'next':
+            index = bisect.bisect_right(keys, pos)
+            if index < len(keys):
+                return keys[index]
+            return keys[0] if cycle else None
+        else:
+            index = bisect.bisect_left(keys, pos)
+            if index > 0:
+                return keys[index - 1]
+            return keys[-1] if cycle else None
+
+    def next_disagreement(self, cursor, linking_pos, direction, moving_link, cycle=True):
+        """The span to move to. When moving a link, this is the next item
+        that not everyone has. Otherwise it is the next span linked to the
+        linking position (or, without one, the next span of an item that not
+        everyone has)."""
+        if self.spans is None:
+            self._build_index()
+        if moving_link:
+            keys = self.last_spans
+            pos = span_key(linking_pos)
+        elif linking_pos is None:
+            keys = self.disputed_spans
+            pos = span_key(cursor)
+        else:
+            keys = self.linked.get(span_key(linking_pos), ())
+            pos = span_key(cursor)
+        key = self._step(keys, pos, direction, cycle)
+        return None if key is None else self.spans[key]
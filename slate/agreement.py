@@ -0,0 +1,483 @@
+from __future__ import print_function
+
+import argparse
+import bisect
+import collections
+import functools
+import glob
+import json
+import multiprocessing
+import sys
+import time
+
+from .adjudication import Adjudication, item_key, span_key
+from .config import Config
+from .data import process_fileinfo, read_annotation_file, read_predictions_file
+from .fileformat import PREDICTIONS_SUFFIX
+
+# Inter-annotator agreement for the annotation files listed in data list
+# files (see "Comparing Annotations" in the README). Each line's other
+# annotation files are the annotators, compared in the order they are given.
+# Every file is scored separately, in a pool of processes, and its counts are
+# summed so that the scores are over the whole collection.
+#
+# Categorical annotations get Cohen's kappa (for each pair of annotators) and
+# Fleiss' kappa (over all of them), with each token / line / character as a
+# unit whose category is the set of labels on it. Link annotations get MUC and
+# B-cubed, with the clusters formed by following links. Both get span F1,
+# either requiring exactly the same spans and labels, or only that the spans
+# overlap and the labels are the same.
+
+NO_LABEL = ''
+
+SCOPE_LENGTH = {'document': 0, 'line': 1, 'token': 2, 'character': 3}
+
+def count_units(doc, scope):
+    """The number of positions at this scope in the document."""
+    if scope == 'document':
+        return 1
+    store = doc.store
+    if store is not None:
+        if scope == 'line':
+            return len(store.nonblank_lines)
+        elif scope == 'token':
+            return store.total_tokens()
+        else:
+            return store.total_chars()
+    length = SCOPE_LENGTH[scope]
+    first = doc.first_char[:length]
+    last = doc.last_char[:length]
+    return sum(1 for _ in doc.iter_positions(first, last))
+
+def unit_categories(doc, items):
+    """position -> the labels on it, for every position with a label."""
+    labels = {}
+    for item in items:
+        for span in item.spans:
+            for pos in doc.iter_positions(span.start, span.end):
+                if pos in labels:
+                    labels[pos].update(item.labels)
+                else:
+                    labels[pos] = set(item.labels)
+    return {pos: ' '.join(sorted(pos_labels)) for pos, pos_labels in labels.items()}
+
+class AnnotationSet(object):
+    """One annotator's items for a document, with their keys, and with their
+    spans grouped by label set and sorted by first character, for finding
+    whether any of them overlaps a span."""
+
+    def __init__(self, doc, items):
+        self.items = items
+        self.keys = [item_key(item) for item in items]
+        self.key_counts = collections.Counter(self.keys)
+        # The first and last character of each span of each item
+        self.bounds = []
+        groups = {}
+        for item, key in zip(items, self.keys):
+            bounds = [doc.span_bounds(span) for span in item.spans]
+            groups.setdefault(key[1], []).extend(bounds)
+            self.bounds.append(bounds)
+
+        self.groups = {}
+        for labels, entries in groups.items():
+            entries.sort()
+            # The furthest end of any span up to each one, so that the search
+            # back through spans that start early enough can stop
+            max_ends = []
+            for _, end in entries:
+                if len(max_ends) > 0 and max_ends[-1] > end:
+                    end = max_ends[-1]
+                max_ends.append(end)
+            self.groups[labels] = (
+                [start for start, _ in entries],
+                [end for _, end in entries],
+                max_ends,
+            )
+
+    def __len__(self):
+        return len(self.items)
+
+    def overlaps(self, item, key, bounds):
+        """Whether an item has the same labels as one of these, and a span
+        that shares text with one of its spans."""
+        if key in self.key_counts:
+            return True
+        group = self.groups.get(key[1])
+        if group is None:
+            return False
+        starts, ends, max_ends = group
+        for start, end in bounds:
+            # Spans that start by the end of this one, and end at or after
+            # its start, share at least one character with it
+            index = bisect.bisect_right(starts, end) - 1
+            while index >= 0 and max_ends[index] >= start:
+                if ends[index] >= start:
+                    return True
+                index -= 1
+        return False
+
+    def count_overlapping(self, other):
+        """The number of these items that overlap one in other."""
+        return sum(1 for item, key, bounds in zip(self.items, self.keys, self.bounds)
+                if other.overlaps(item, key, bounds))
+
+def get_clusters(items):
+    """mention -> cluster id, where a mention is a (start, end) pair and
+    mentions are in the same cluster if there is a chain of links between
+    them."""
+    parent = {}
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+    for item in items:
+        keys = [span_key(span) for span in item.spans]
+        for key in keys:
+            parent.setdefault(key, key)
+        root = find(keys[0])
+        for key in keys[1:]:
+            other = find(key)
+            if other != root:
+                parent[other] = root
+    return {key: find(key) for key in parent}
+
+def group_clusters(mention_to_cluster):
+    clusters = collections.defaultdict(set)
+    for mention, cluster in mention_to_cluster.items():
+        clusters[cluster].add(mention)
+    return clusters
+
+def muc_counts(key, response):
+    """Numerator and denominator of MUC recall of response against key.
+    Mentions missing from response count as clusters on their own."""
+    num = 0
+    den = 0
+    for members in group_clusters(key).values():
+        parts = {response.get(mention, mention) for mention in members}
+        num += len(members) - len(parts)
+        den += len(members) - 1
+    return num, den
+
+def b3_counts(key, response):
+    """Sum and count of B-cubed recall of response against key, over the
+    mentions in key. Mentions missing from response are clusters on their
+    own."""
+    response_clusters = group_clusters(response)
+    total = 0.0
+    count = 0
+    for members in group_clusters(key).values():
+        for mention in members:
+            if mention in response:
+                shared = len(members & response_clusters[response[mention]])
+            else:
+                shared = 1
+            total += shared / float(len(members))
+            count += 1
+    return total, count
+
+PAIR_FIELDS = [
+    # Span F1
+    'items_a', 'items_b', 'exact', 'overlap_a', 'overlap_b',
+    # Clusters (only filled for link annotation)
+    'muc_r_num', 'muc_r_den', 'muc_p_num', 'muc_p_den',
+    'b3_r_sum', 'b3_r_count', 'b3_p_sum', 'b3_p_count',
+]
+
+def pair_counts(a, b, link):
+    """Counts for comparing two AnnotationSets."""
+    counts = dict.fromkeys(PAIR_FIELDS, 0)
+    counts['items_a'] = len(a)
+    counts['items_b'] = len(b)
+    counts['exact'] = sum((a.key_counts & b.key_counts).values())
+    counts['overlap_a'] = a.count_overlapping(b)
+    counts['overlap_b'] = b.count_overlapping(a)
+
+    if link:
+        clusters_a = get_clusters(a.items)
+        clusters_b = get_clusters(b.items)
+        counts['muc_r_num'], counts['muc_r_den'] = muc_counts(clusters_a, clusters_b)
+        counts['muc_p_num'], counts['muc_p_den'] = muc_counts(clusters_b, clusters_a)
+        counts['b3_r_sum'], counts['b3_r_count'] = b3_counts(clusters_a, clusters_b)
+        counts['b3_p_sum'], counts['b3_p_count'] = b3_counts(clusters_b, clusters_a)
+    return counts
+
+def new_counts():
+    return {
+        'files': 0,
+        'skipped': 0,
+        'items': 0,
+        'items_agreed': 0,
+        # Tuple of each annotator's category -> number of units
+        'units': collections.Counter(),
+        # (annotator, annotator) -> counts for PAIR_FIELDS
+        'pairs': {},
+    }
+
+def add_counts(total, counts):
+    for name in ['files', 'skipped', 'items', 'items_agreed']:
+        total[name] += counts[name]
+    total['units'].update(counts['units'])
+    for pair, pair_total in counts['pairs'].items():
+        if pair not in total['pairs']:
+            total['pairs'][pair] = dict.fromkeys(PAIR_FIELDS, 0)
+        for name in PAIR_FIELDS:
+            total['pairs'][pair][name] += pair_total[name]
+
+_config = None
+def get_config(args):
+    # Built once in each process, rather than sent with every file
+    global _config
+    if _config is None:
+        _config = Config(args)
+    return _config
+
+def read_sets(config, filenames, doc):
+    """The items in each annotation (or predictions) file."""
+    sets = []
+    for filename in filenames:
+        if filename.endswith(PREDICTIONS_SUFFIX):
+            sets.append([item for item, _ in read_predictions_file(config, filename, doc)])
+        else:
+            sets.append(read_annotation_file(config, filename, doc))
+    return sets
+
+def score_file(args, file_info):
+    """Counts for one line of a data list."""
+    config = get_config(args)
+    counts = new_counts()
+    raw_file, position, output_file, annotation_files = process_fileinfo([file_info], config)[0]
+    if args.include_output:
+        annotation_files = [output_file] + annotation_files
+    if len(annotation_files) < 2:
+        counts['skipped'] = 1
+        return counts
+    counts['files'] = 1
+
+    doc = position.doc
+    sets = read_sets(config, annotation_files, doc)
+    adjudication = Adjudication(sets)
+    counts['items'] = len(adjudication)
+    counts['items_agreed'] = sum(1 for _, _, count in adjudication.items if count == len(sets))
+
+    link = config.annotation_type == 'link'
+    if not link:
+        categories = [unit_categories(doc, items) for items in sets]
+        labelled = set()
+        for annotator in categories:
+            labelled.update(annotator)
+        for pos in labelled:
+            counts['units'][tuple(annotator.get(pos, NO_LABEL) for annotator in categories)] += 1
+        unlabelled = count_units(doc, config.annotation) - len(labelled)
+        counts['units'][(NO_LABEL,) * len(sets)] += unlabelled
+
+    sets = [AnnotationSet(doc, items) for items in sets]
+    for i in range(len(sets)):
+        for j in range(i + 1, len(sets)):
+            counts['pairs'][i, j] = pair_counts(sets[i], sets[j], link)
+    return counts
+
+def ratio(num, den):
+    return num / float(den) if den > 0 else None
+
+def f1(precision, recall):
+    if precision is None or recall is None:
+        return None
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+def prf(precision, recall):
+    return {'precision': precision, 'recall': recall, 'f1': f1(precision, recall)}
+
+def kappa(observed, expected):
+    if observed is None or expected is None or expected == 1:
+        return None
+    return (observed - expected) / (1 - expected)
+
+def cohen_kappa(units, i, j):
+    total = 0
+    agreed = 0
+    first = collections.Counter()
+    second = collections.Counter()
+    for categories, count in units.items():
+        if len(categories) > j:
+            total += count
+            if categories[i] == categories[j]:
+                agreed += count
+            first[categories[i]] += count
+            second[categories[j]] += count
+    if total == 0:
+        return None
+    expected = sum(first[category] * second[category] for category in first) / float(total * total)
+    return kappa(agreed / float(total), expected)
+
+def fleiss_kappa(units):
+    total_units = 0
+    total_ratings = 0
+    observed = 0.0
+    category_ratings = collections.Counter()
+    for categories, count in units.items():
+        raters = len(categories)
+        per_category = collections.Counter(categories)
+        agreeing_pairs = sum(n * (n - 1) for n in per_category.values())
+        observed += count * agreeing_pairs / float(raters * (raters - 1))
+        total_units += count
+        total_ratings += count * raters
+        for category, n in per_category.items():
+            category_ratings[category] += count * n
+    if total_units == 0:
+        return None
+    expected = sum((n / float(total_ratings)) ** 2 for n in category_ratings.values())
+    return kappa(observed / total_units, expected)
+
+def pair_scores(counts, link):
+    scores = {
+        'exact': prf(ratio(counts['exact'], counts['items_b']), ratio(counts['exact'], counts['items_a'])),
+        'overlap': prf(ratio(counts['overlap_b'], counts['items_b']), ratio(counts['overlap_a'], counts['items_a'])),
+    }
+    if link:
+        scores['muc'] = prf(ratio(counts['muc_p_num'], counts['muc_p_den']), ratio(counts['muc_r_num'], counts['muc_r_den']))
+        scores['b3'] = prf(ratio(counts['b3_p_sum'], counts['b3_p_count']), ratio(counts['b3_r_sum'], counts['b3_r_count']))
+    return scores
+
+def get_scores(total, link):
+    """Scores from summed counts. For each pair of annotators the first is
+    treated as the reference, so precision is over the second's items."""
+    scores = {
+        'files': total['files'],
+        'skipped': total['skipped'],
+        'items': total['items'],
+        'items_agreed': total['items_agreed'],
+        'pairs': [],
+    }
+    if not link:
+        scores['fleiss_kappa'] = fleiss_kappa(total['units'])
+    all_pairs = dict.fromkeys(PAIR_FIELDS, 0)
+    for (i, j), counts in sorted(total['pairs'].items()):
+        pair = pair_scores(counts, link)
+        pair['annotators'] = [i + 1, j + 1]
+        if not link:
+            pair['cohen_kappa'] = cohen_kappa(total['units'], i, j)
+        scores['pairs'].append(pair)
+        for name in PAIR_FIELDS:
+            all_pairs[name] += counts[name]
+    scores['all_pairs'] = pair_scores(all_pairs, link)
+    return scores
+
+def format_score(value):
+    return '-' if value is None else "{:.3f}".format(value)
+
+def print_scores(scores, link, out=sys.stdout):
+    print("Files scored: {}".format(scores['files']), file=out)
+    if scores['skipped'] > 0:
+        print("Files skipped (fewer than two annotation files): {}".format(scores['skipped']), file=out)
+    agreed = ratio(scores['items_agreed'], scores['items'])
+    print("Items all annotators agree on: {} of {} ({})".format(
+        scores['items_agreed'], scores['items'], format_score(agreed)), file=out)
+    if not link:
+        print("Fleiss' kappa: {}".format(format_score(scores['fleiss_kappa'])), file=out)
+
+    metrics = ['exact', 'overlap']
+    if link:
+        metrics += ['muc', 'b3']
+    header = ['Annotators']
+    if not link:
+        header.append('Kappa')
+    for metric in metrics:
+        header += [metric + ' P', 'R', 'F1']
+    rows = [header]
+    for pair in scores['pairs'] + [dict(scores['all_pairs'], annotators=None)]:
+        if pair['annotators'] is None:
+            row = ['All']
+        else:
+            row = ['{} vs {}'.format(*pair['annotators'])]
+        if not link:
+            row.append(format_score(pair.get('cohen_kappa')))
+        for metric in metrics:
+            row += [format_score(pair[metric][part]) for part in ['precision', 'recall', 'f1']]
+        rows.append(row)
+    widths = [max(len(row[col]) for row in rows) for col in range(len(header))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)), file=out)
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Measure agreement between sets of annotations. '
+            'Each line of a data list is scored using its other annotation '
+            'files, which are numbered in the order given.',
+            fromfile_prefix_chars='@')
+    parser.add_argument('data', nargs="*",
+            help='Lines of a data list')
+    parser.add_argument('-d', '--data-list', nargs="+",
+            help='Files containing lists of files to be scored')
+
+    parser.add_argument('-t', '--ann-type',
+            choices=['categorical', 'link'],
+            default='categorical',
+            help='The type of annotation being done.')
+    parser.add_argument('-s', '--ann-scope',
+            choices=['character', 'token', 'line', 'document'],
+            default='token',
+            help='The scope of annotation being done.')
+    parser.add_argument('-c', '--config-file',
+            help='A file containing configuration information.')
+    parser.add_argument('--lazy-load',
+            action='store_true',
+            help='Memory-map input files and only read the lines in use '
+            '(for very large files).')
+
+    parser.add_argument('--include-output',
+            action='store_true',
+            help='Also score the output file of each line, as the first annotator.')
+    parser.add_argument('-j', '--jobs',
+            default=multiprocessing.cpu_count(), type=int,
+            help='Number of processes to use (default: one per CPU).')
+    parser.add_argument('--json',
+            action='store_true',
+            help='Print scores as JSON.')
+    # Output files are only read
+    parser.set_defaults(overwrite=True)
+
+    args = parser.parse_args()
+
+    if len(args.data) == 0 and args.data_list is None:
+        parser.error("No filenames or data lists provided")
+
+    file_info = args.data
+    if args.data_list is not None:
+        for filename in args.data_list:
+            if len(glob.glob(filename)) == 0:
+                raise Exception("Cannot open / find '{}'".format(filename))
+            for line in open(filename):
+                if len(line.strip()) > 0:
+                    file_info.append(line.strip())
+
+    start = time.time()
+    total = new_counts()
+    score = functools.partial(score_file, args)
+    if args.jobs > 1 and len(file_info) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        try:
+            chunksize = max(1, len(file_info) // (args.jobs * 4))
+            for counts in pool.imap_unordered(score, file_info, chunksize):
+                add_counts(total, counts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for line in file_info:
+            add_counts(total, score(line))
+    taken = time.time() - start
+
+    link = args.ann_type == 'link'
+    scores = get_scores(total, link)
+    if args.json:
+        print(json.dumps(scores, indent=2, sort_keys=True))
+    else:
+        print_scores(scores, link)
+        print("Took {:.2f} seconds ({:.0f} files per second)".format(
+            taken, len(file_info) / taken if taken > 0 else 0))
+
+if __name__ == '__main__':
+    main()
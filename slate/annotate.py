@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import argparse
+import cProfile
 import curses
 import datetime
 import logging
@@ -9,8 +10,17 @@ import sys
 
 from .data import *
 from .config import *
+from .loader import DatumLoader
+from .profiling import Profiler
 from .view import *
 
+# Moves where a key held down can be treated as if the number of repeats had
+# been typed first. Up and down are not included because they keep the token
+# number of the shortest line passed through when done one at a time.
+REPEATABLE_ACTIONS = set([
+    'move-left', 'move-right', 'move-link-left', 'move-link-right',
+])
+
 class Annotator(object):
     def __init__(self, config, filenames, current_mode, args):
         self.current_mode = current_mode
@@ -23,8 +33,15 @@ class Annotator(object):
         self.datum = None
         self.view = None
         self.window = None
+        self.screen = None
         self.config = config
         self.args = args
+        # Position in the key sequence trie for the current mode
+        self.key_node = None
+        # Timing of each keypress, when asked for
+        self.profiler = Profiler() if args.profile else None
+        self.loader = DatumLoader(config, filenames, args.cache_memory * 2 ** 20)
+        self.save_on_quit = True
         self.action_to_function = {
             'delete-query-char': self.delete_typing_char,
             'leave-query-mode': self.leave_typing_mode,
@@ -181,20 +198,37 @@ class Annotator(object):
         else:
             self.partial_typing += char
 
+    def load_datum(self):
+        self.filename, start_pos, _, _ = self.filenames[self.cfilename]
+        self.datum = self.loader.load(self.cfilename)
+        if not self.args.readonly and self.datum.journal is None:
+            self.datum.start_journal()
+        return start_pos
+
+    def close_datum(self, save=True):
+        # Kept by the loader, which writes out its edits in the background
+        if self.datum is not None:
+            if save:
+                self.loader.release(self.cfilename, self.datum)
+            else:
+                self.datum.discard_unsaved()
+            self.datum = None
+
     def change_file(self, user_input, action):
         if self.current_mode[-1] != 'no_file':
             self.save_or_quit(None, 'save')
+            self.close_datum()
 
         direction = 1 if 'next' in action else -1
         if self.current_mode[-1] == 'no_file':
             if (self.cfilename < 0) == (direction > 0):
                 self.current_mode.pop()
                 self.cfilename += direction
+                start_pos = self.load_datum()
+                self.get_view(self.config, self.cfilename, len(self.filenames), start_pos, self.view)
         elif 0 <= self.cfilename + direction < len(self.filenames):
             self.cfilename += direction
-            self.filename, start_pos, output_file, annotation_files = \
-                    self.filenames[self.cfilename]
-            self.datum = Datum(self.filename, self.config, output_file, annotation_files)
+            start_pos = self.load_datum()
             self.get_view(self.config, self.cfilename, len(self.filenames), start_pos, self.view)
         elif self.current_mode != 'no_file':
             self.cfilename += direction
@@ -267,8 +301,9 @@ class Annotator(object):
 
     def save_or_quit(self, user_input, action):
         if 'save' in action:
-            if self.current_mode[-1] != 'read':
-                self.datum.write_out()
+            # Leaving a file has already saved it
+            if self.current_mode[-1] not in ('read', 'no_file'):
+                self.datum.save()
 
             # TODO: Save both cursor and linking pos
             if 0 <= self.cfilename < len(self.filenames):
@@ -282,6 +317,9 @@ class Annotator(object):
             if 'save' not in action:
                 # TODO: Have an 'are you sure?' step
                 pass
+            # Without saving, edits since the last save are dropped
+            self.save_on_quit = 'save' in action
+            self.close_datum(self.save_on_quit)
             return 'quit'
 
     def search(self, user_input, action):
@@ -315,13 +353,98 @@ class Annotator(object):
         else:
             return "UNKNOWN"
 
+    def read_keys(self):
+        """Wait for a key, then take any others already queued, so that a
+        burst of key repeats or pasted text is rendered once."""
+        keys = [self.window.getch()]
+        self.window.nodelay(True)
+        try:
+            while True:
+                ch = self.window.getch()
+                if ch == -1:
+                    break
+                keys.append(ch)
+        finally:
+            self.window.nodelay(False)
+        return keys
+
+    def process_keys(self, keys):
+        """Apply a batch of keys in order. Repeats of a movement key are
+        merged into a single move, as if the number had been typed first."""
+        pos = 0
+        while pos < len(keys):
+            ch = keys[pos]
+            repeats = 1
+            if self.key_node is None and self.current_num is None:
+                keymap = self.config.get_keymap(self.current_mode[-1])
+                node = keymap.children.get(self.input_to_symbol(ch))
+                if node is not None and self.can_merge_repeats(node.action):
+                    while pos + repeats < len(keys) and keys[pos + repeats] == ch:
+                        repeats += 1
+                    if repeats > 1:
+                        self.current_num = repeats
+            pos += repeats
+            if self.process_input(ch) == 'quit':
+                return 'quit'
+
+    def can_merge_repeats(self, action):
+        if action not in REPEATABLE_ACTIONS or self.current_mode[-1] == 'no_file':
+            return False
+        view = self.view
+        mover = view.linking_pos if 'link' in action else view.cursor
+        if mover is None or mover.start != mover.end:
+            # A wider span stops moving when one end reaches the edge
+            return False
+        if view.linking_pos is not None and (self.args.prevent_self_links or
+                self.args.prevent_forward_links):
+            # One long move that is not allowed goes as far as it can, which
+            # depends on the distance
+            return False
+        return True
+
+    def process_input(self, ch):
+        """Take one more key, stepping through the key sequence trie for the
+        current mode, and run the action once a complete input is typed."""
+        next_user_input = self.input_to_symbol(ch)
+        mode = self.current_mode[-1]
+        logging.debug("Input %s converted to %s in mode %s", ch, next_user_input, self.current_mode)
+
+        # Modes only change when an action runs, which starts a new sequence
+        keymap = self.config.get_keymap(mode)
+        node = self.key_node
+        if node is not None:
+            node = node.children.get(next_user_input)
+        if node is None:
+            # Not a continuation, so start a new sequence with this key
+            node = keymap.children.get(next_user_input, keymap)
+        self.key_node = node
+
+        # Determine what to do for the input
+        action = node.action
+        function = self.action_to_function.get(action)
+        logging.debug("%s %s -> %s %s", self.current_mode, node.symbols, action, function)
+
+        if self.profiler is not None:
+            self.profiler.mark('dispatch')
+
+        # Do it!
+        if function is not None:
+            self.key_node = None
+            outcome = function(node.symbols, action)
+            if self.profiler is not None:
+                self.profiler.mark('action')
+            return outcome
+
     def get_view(self, config, file_num, total_files, position, prev_view=None):
         cursor = position
         link = position if self.config.annotation_type == 'link' else None
-        self.view = View(self.window, cursor, link, self.datum, self.config, file_num, total_files, prev_view)
+        self.view = View(self.screen, cursor, link, self.datum, self.config, file_num, total_files, prev_view)
+        self.view.profiler = self.profiler
 
     def annotate(self, window_in):
         self.window = window_in
+        # Views draw into this, which only sends changes to the window
+        self.screen = FrameBuffer(window_in)
 
         # Set color combinations
         curses.use_default_colors()
@@ -332,8 +455,7 @@ class Annotator(object):
         curses.curs_set(0)
 
         self.cfilename = 0
-        self.filename, start_pos, output_file, annotation_files = self.filenames[self.cfilename]
-        self.datum = Datum(self.filename, self.config, output_file, annotation_files)
+        start_pos = self.load_datum()
         self.get_view(self.config, self.cfilename, len(self.filenames), start_pos)
         if self.args.show_help:
             self.view.toggle_help()
@@ -344,10 +466,6 @@ class Annotator(object):
         if self.args.show_mark:
             self.view.toggle_current_mark()
 
-        last_num = None
-        at_end = None
-        nsteps = 0
-        user_input = []
         while True:
             # Draw screen
             if self.current_mode[-1] == 'no_file':
@@ -360,45 +478,20 @@ class Annotator(object):
 
                 self.view.render(tmp_term, self.partial_typing)
             self.view.must_show_linking_pos = False
+            if self.profiler is not None:
+                self.profiler.finish(self.filename)
 
-            # Get input
-            ch = self.window.getch()
-            next_user_input = self.input_to_symbol(ch)
-            logging.debug("Input {} converted to {} in mode {}".format(ch, next_user_input, self.current_mode))
-            user_input.append(next_user_input)
-            tuser_input = tuple(user_input)
-            if (self.current_mode[-1], tuser_input) not in self.config.valid_prefixes:
-                if (None, tuser_input) not in self.config.valid_prefixes:
-                    if (self.current_mode[-1], tuser_input) not in self.config.input_to_action:
-                        if (None, tuser_input) not in self.config.input_to_action:
-                            user_input = [next_user_input]
-                            tuser_input = (next_user_input,)
-            nsteps += 1
-            if nsteps % 100 == 0 and self.current_mode[-1] == 'category':
-                self.datum.write_out()
-
-            # Determine what to do for the input
-            action = None
-            function = None
-            if (self.current_mode[-1], tuser_input) in self.config.input_to_action:
-                action = self.config.input_to_action[self.current_mode[-1], tuser_input]
-                if action in self.action_to_function:
-                    function = self.action_to_function[action]
-            elif (None, tuser_input) in self.config.input_to_action:
-                action = self.config.input_to_action[None, tuser_input]
-                if action in self.action_to_function:
-                    function = self.action_to_function[action]
-            logging.debug("{} {} -> {} {}".format(self.current_mode, tuser_input, action, function))
-
-            # Do it!
-            if function is not None:
-                outcome = function(tuser_input, action)
-                user_input = []
-                if outcome == 'quit':
-                    break
+            # Get input, applying everything typed since the last render
+            keys = self.read_keys()
+            if self.profiler is not None:
+                self.profiler.start()
+            if self.process_keys(keys) == 'quit':
+                break
+
+            # Start a blank frame for rendering the screen again
+            self.screen.clear()
 
-            # Clear the screen in preparation for rendering it again
-            self.window.clear()
+        self.loader.close(self.save_on_quit)
 
         # Write out information for continuing annotation later
         out_filename = self.args.log_prefix + '.todo'
@@ -413,6 +506,9 @@ class Annotator(object):
             print(" ".join(parts), file=out)
         out.close()
 
+        if self.profiler is not None:
+            self.profiler.write(self.args.log_prefix + '.profile')
+
 def ext_annotate(window_in, annotator):
     annotator.annotate(window_in)
 
@@ -464,6 +560,28 @@ def main():
             action='store_true',
             help='If they exist already, read and overwrite output files.')
 
+    parser.add_argument('--lazy-load',
+            action='store_true',
+            help='Memory-map input files and only read the lines in use '
+            '(for very large files).')
+
+    parser.add_argument('--cache-memory',
+            default=200, type=int,
+            help='Megabytes of recently visited files to keep in memory (default: 200).')
+
+    parser.add_argument('--search-regex',
+            action='store_true',
+            help='Interpret search queries as regular expressions.')
+
+    parser.add_argument('--profile',
+            action='store_true',
+            help='Record the time taken by each stage of handling every '
+            'keypress, written to LOG_PREFIX.profile on quitting.')
+    parser.add_argument('--profile-calls',
+            action='store_true',
+            help='Record function calls with cProfile, written to '
+            'LOG_PREFIX.cprofile on quitting (read it with python -m pstats).')
+
     parser.add_argument('-ps', '--prevent-self-links',
             action='store_true',
             help='Prevent an item from being linked to itself.')
@@ -534,4 +652,13 @@ def main():
 
     ### Start interface
     annotator = Annotator(config, filenames, current_mode, args)
-    curses.wrapper(ext_annotate, annotator)
+    if args.profile_calls:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            curses.wrapper(ext_annotate, annotator)
+        finally:
+            profile.disable()
+            profile.dump_stats(args.log_prefix + '.cprofile')
+    else:
+        curses.wrapper(ext_annotate, annotator)
@@ -0,0 +1,189 @@
+from __future__ import print_function
+
+import argparse
+import functools
+import glob
+import json
+import multiprocessing
+import time
+
+from .config import Config
+from .data import Datum, Span, process_fileinfo
+from .fileformat import json_spans
+
+# Applies annotation operations to the files of a data list without the
+# interface, e.g. to load a model's predictions before people review them.
+# Operations are read from JSON lines files, one operation per line:
+#   {"file": "my-book.txt", "op": "add", "spans": [[[3, 5], [3, 8]]], "label": "PER"}
+#   {"file": "my-book.txt", "op": "remove", "spans": [[[3, 5], [3, 8]]]}
+# "file" is the raw file as it appears in the data list. "spans" follows the
+# annotation file format, either as JSON lists or as a string like
+# "((3, 5), (3, 8))". "add" gives the spans the label (or, for links, creates
+# the link) if they do not have it already. "remove" takes the label off, or
+# without a label removes every item on the spans. Each file's operations are
+# applied in the order they were read, in a pool of processes, and then its
+# output file is written once.
+
+OPERATIONS = ('add', 'remove')
+
+def read_operations(filename):
+    """Yields (line number, file, operation, spans, label) for each line of a
+    JSON lines file, where spans are position tuples or (start, end) pairs."""
+    for line_no, line in enumerate(open(filename), 1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            op = json.loads(line)
+            spans = json_spans(op['spans'])
+            action = op['op']
+            if action not in OPERATIONS:
+                raise ValueError("Unknown operation {}".format(action))
+            yield line_no, op['file'], action, spans, op.get('label')
+        except (ValueError, KeyError, TypeError) as e:
+            raise Exception("{}:{}: {}".format(filename, line_no, e))
+
+def apply_operations(datum, operations):
+    """Apply (source, line number, operation, spans, label) tuples to a
+    Datum, where source and line number are only used in error messages.
+    Returns the number that changed something."""
+    config = datum.config
+    doc = datum.doc
+    changed = 0
+    for source, line_no, action, spans, label in operations:
+        try:
+            spans = [Span(config.annotation, doc, span) for span in spans]
+        except AssertionError as e:
+            raise Exception("{}:{}: {}".format(source, line_no, e))
+        for span in spans:
+            if not (doc.valid_pos(span.start) and doc.valid_pos(span.end)):
+                raise Exception("{}:{}: {} is not a valid {} span for {}".format(
+                    source, line_no, span, config.annotation, datum.filename))
+        if config.annotation_type == 'link':
+            label = None
+
+        if action == 'remove' and label is None:
+            if len(datum.get_item_with_spans(spans, config.annotation_type == 'link')) == 0:
+                continue
+            datum.remove_annotation(spans)
+        else:
+            # modify_annotation toggles, so only use it when that will have
+            # the effect asked for
+            items = datum.get_item_with_spans(spans)
+            if label is None:
+                present = len(items) > 0
+            else:
+                present = any(label in item.labels for item in items)
+            if present == (action == 'add'):
+                continue
+            datum.modify_annotation(spans, label)
+        changed += 1
+    return changed
+
+_config = None
+def get_config(args):
+    # Built once in each process, rather than sent with every file
+    global _config
+    if _config is None:
+        _config = Config(args)
+    return _config
+
+def apply_to_file(args, task):
+    """Apply operations to the output file of one line of a data list.
+    Returns (operations, operations that changed something)."""
+    file_info, operations = task
+    config = get_config(args)
+    raw_file, position, output_file, _ = process_fileinfo([file_info], config)[0]
+    # Other annotations are only needed for comparison in the interface
+    datum = Datum(raw_file, config, output_file, [], position.doc)
+    changed = apply_operations(datum, operations)
+    if changed > 0 or args.write_unchanged:
+        datum.write_out()
+    return len(operations), changed
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Apply annotation operations from JSON lines files '
+            'to the files in a data list, without the interface.',
+            fromfile_prefix_chars='@')
+    parser.add_argument('operations', nargs="+",
+            help='JSON lines files of operations ("-" for standard input)')
+    parser.add_argument('-d', '--data-list', nargs="+", required=True,
+            help='Files containing lists of files to be annotated')
+
+    parser.add_argument('-t', '--ann-type',
+            choices=['categorical', 'link'],
+            default='categorical',
+            help='The type of annotation being done.')
+    parser.add_argument('-s', '--ann-scope',
+            choices=['character', 'token', 'line', 'document'],
+            default='token',
+            help='The scope of annotation being done.')
+    parser.add_argument('-c', '--config-file',
+            help='A file containing configuration information.')
+    parser.add_argument('--lazy-load',
+            action='store_true',
+            help='Memory-map input files and only read the lines in use '
+            '(for very large files).')
+
+    parser.add_argument('--write-unchanged',
+            action='store_true',
+            help='Write output files even when no operation changed them.')
+    parser.add_argument('-j', '--jobs',
+            default=multiprocessing.cpu_count(), type=int,
+            help='Number of processes to use (default: one per CPU).')
+    # Existing annotations are read and the operations applied to them
+    parser.set_defaults(overwrite=True)
+
+    args = parser.parse_args()
+
+    file_info = {}
+    for filename in args.data_list:
+        if len(glob.glob(filename)) == 0:
+            raise Exception("Cannot open / find '{}'".format(filename))
+        for line in open(filename):
+            if len(line.strip()) > 0:
+                file_info[line.split()[0]] = line.strip()
+
+    start = time.time()
+    by_file = {}
+    unknown = set()
+    for filename in args.operations:
+        source = '/dev/stdin' if filename == '-' else filename
+        for line_no, raw_file, action, spans, label in read_operations(source):
+            if raw_file not in file_info:
+                unknown.add(raw_file)
+            by_file.setdefault(raw_file, []).append((source, line_no, action, spans, label))
+    if len(unknown) > 0:
+        raise Exception("Operations are for files that are not in the data list:\n" +
+                '\n'.join(sorted(unknown)))
+
+    tasks = [(file_info[raw_file], operations) for raw_file, operations in by_file.items()]
+    # Largest first, so that one big file does not finish alone at the end
+    tasks.sort(key=lambda task: -len(task[1]))
+    total = 0
+    changed = 0
+    apply = functools.partial(apply_to_file, args)
+    if args.jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        try:
+            for num_ops, num_changed in pool.imap_unordered(apply, tasks):
+                total += num_ops
+                changed += num_changed
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            num_ops, num_changed = apply(task)
+            total += num_ops
+            changed += num_changed
+    taken = time.time() - start
+
+    print("Applied {} operations ({} changed annotations) to {} files in {:.2f} seconds".format(
+        total, changed, len(tasks), taken))
+    if taken > 0:
+        print("{:.0f} operations per second, {:.1f} files per second".format(
+            total / taken, len(tasks) / taken))
+
+if __name__ == '__main__':
+    main()
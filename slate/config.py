@@ -226,6 +226,24 @@ def keydef_to_symbols(keydef):
             symbols[-1] += char
     return symbols
 
+class KeyNode(object):
+    """A point part way through typing a key sequence. Children are keyed by
+    the next symbol, and action is set when the symbols so far are a complete
+    input."""
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.action = None
+        self.children = {}
+
+    def add(self, symbols, action):
+        node = self
+        for symbol in symbols:
+            child = node.children.get(symbol)
+            if child is None:
+                child = node.children[symbol] = KeyNode(node.symbols + (symbol,))
+            node = child
+        node.action = action
+
 class Config(object):
     def __init__(self, args, labels={}):
         self.args = args
@@ -286,10 +304,26 @@ class Config(object):
             if (mode, symbol) in self.valid_prefixes:
                 raise Exception("input {} overlaps with a prefix".format(symbol))
 
+        # One trie per mode, so each key typed is a single step. Inputs for
+        # all modes are included, with those for the mode taking precedence.
+        self.keymaps = {}
+        modes = set(mode for mode, _ in self.input_to_action)
+        modes.add(None)
+        for mode in modes:
+            root = KeyNode(())
+            for binding_mode in [None, mode] if mode is not None else [None]:
+                for (other, symbol), action in self.input_to_action.items():
+                    if other == binding_mode:
+                        root.add(symbol, action)
+            self.keymaps[mode] = root
+
     def get_color_for_label(self, mark):
         name = self.labels[mark][1]
         return name_to_color[name]
 
+    def get_keymap(self, mode):
+        return self.keymaps.get(mode, self.keymaps[None])
+
     def get_label_for_input(self, user_input):
         return self.input_to_label.get(user_input, None)
 
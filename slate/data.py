@@ -1,10 +1,24 @@
 from __future__ import print_function
 
-import logging
+import array
+import bisect
+import collections
 import glob
+import itertools
+import locale
+import logging
+import mmap
+import operator
+import os
+import re
 import sys
 
+from .adjudication import Adjudication
 from .config import *
+from .fileformat import BINARY_SUFFIX, PREDICTIONS_SUFFIX, format_line, iter_annotations, iter_predictions, normalise_spans, parse_literal, write_binary
+from .journal import Journal
+from .review import ReviewQueue
+from .search import SearchIndex
 
 def process_fileinfo(file_info, config):
     filenames = []
@@ -25,7 +39,7 @@ def process_fileinfo(file_info, config):
             next_part += 1
 
         # Start somewhere other than the top
-        d = Document(raw_file)
+        d = Document(raw_file, config.args.lazy_load)
         position = Span(config.annotation, d)
         if len(parts) > next_part:
             position_text = []
@@ -40,7 +54,7 @@ def process_fileinfo(file_info, config):
                 next_part += 1
             position_text = ' '.join(position_text)
 
-            span = eval(position_text)
+            span, _ = parse_literal(position_text)
             position = Span(config.annotation, d, span)
             if (not position.doc.valid_pos(position.start)) or (not position.doc.valid_pos(position.end)):
                 raise Exception("The starting location in data list file is not the location of a token in the document.")
@@ -72,30 +86,280 @@ def process_fileinfo(file_info, config):
         raise Exception(error)
     return filenames
 
+class MappedLines(object):
+    """The lines of a memory-mapped file, decoded when they are used.
+
+    Behaves like a read-only list of strings. Only the most recently used
+    lines are kept, so memory use depends on what is being looked at rather
+    than on the size of the file."""
+
+    def __init__(self, filename, cache_size=10000):
+        self.encoding = locale.getpreferredencoding(False)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+        self.file = open(filename, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        assert size > 0, "Empty document: {}".format(filename)
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Find the start of every line, a chunk at a time
+        self.offsets = array.array('q', [0])
+        chunk_size = 1 << 24
+        pos = 0
+        while pos < size:
+            end = min(size, pos + chunk_size)
+            lengths = [len(part) + 1 for part in self.mapped[pos:end].split(b"\n")[:-1]]
+            self.offsets.extend(map(pos.__add__, itertools.accumulate(lengths)))
+            pos = end
+        self.size = size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, line_no):
+        if line_no < 0:
+            line_no += len(self.offsets)
+        if line_no < 0 or line_no >= len(self.offsets):
+            raise IndexError("line index out of range")
+
+        line = self.cache.get(line_no)
+        if line is None:
+            line = self.read_line(line_no)
+            self.cache[line_no] = line
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            # Mark as recently used
+            del self.cache[line_no]
+            self.cache[line_no] = line
+        return line
+
+    def __iter__(self):
+        for line_no in range(len(self.offsets)):
+            yield self.read_line(line_no)
+
+    def read_line(self, line_no):
+        start = self.offsets[line_no]
+        end = self.size
+        if line_no + 1 < len(self.offsets):
+            end = self.offsets[line_no + 1] - 1
+        line = self.mapped[start:end].decode(self.encoding)
+        # Match the newline handling of reading in text mode
+        if line.endswith("\r"):
+            line = line[:-1]
+        return line
+
+    def memory_size(self):
+        return (self.offsets.itemsize * len(self.offsets) +
+                sum(sys.getsizeof(line) for line in self.cache.values()))
+
+class TokenisedLines(object):
+    """The tokens of each line, split when they are used.
+
+    Behaves like a read-only list of lists of tokens, with the same bounded
+    cache of recent lines as MappedLines."""
+
+    def __init__(self, lines, cache_size=10000):
+        self.lines = lines
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, line_no):
+        if line_no < 0:
+            line_no += len(self.lines)
+        tokens = self.cache.get(line_no)
+        if tokens is None:
+            tokens = self.lines[line_no].strip().split()
+            self.cache[line_no] = tokens
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            # Mark as recently used
+            del self.cache[line_no]
+            self.cache[line_no] = tokens
+        return tokens
+
+    def __iter__(self):
+        for line in self.lines:
+            yield line.strip().split()
+
+    def num_tokens(self, line_no):
+        return len(self[line_no])
+
+    def token_length(self, line_no, token_no):
+        return len(self[line_no][token_no])
+
+    def memory_size(self):
+        return sum(sys.getsizeof(tokens) + sum(sys.getsizeof(token) for token in tokens)
+                for tokens in self.cache.values())
+
+class TokenStore(object):
+    """Token boundaries for a whole text, stored in flat arrays.
+
+    Behaves like a read-only list of lists of tokens, but only keeps the
+    text and a few integers per token and line:
+      line_starts  - the number of tokens before each line (plus the total)
+      line_offsets - the character offset of each line (plus the end)
+      token_starts, token_ends - the character offsets of each token
+    Token strings are only created when a line is requested."""
+
+    def __init__(self, text):
+        self.text = text
+        typecode = 'i' if len(text) < 2 ** 31 else 'q'
+        self.line_starts = array.array(typecode, [0])
+        self.line_offsets = array.array(typecode, [0])
+        self.token_starts = array.array(typecode)
+        self.token_ends = array.array(typecode)
+        for match in re.finditer(r'(\n)|[^\s]+', text):
+            if match.lastindex == 1:
+                self.line_starts.append(len(self.token_starts))
+                self.line_offsets.append(match.end())
+            else:
+                self.token_starts.append(match.start())
+                self.token_ends.append(match.end())
+        self.line_starts.append(len(self.token_starts))
+        self.line_offsets.append(len(text) + 1)
+
+        # Lines that have tokens, and the number of characters before each
+        # token (plus the total), for moving by more than one step at once.
+        self.nonblank_lines = array.array(typecode, [line_no for line_no in
+                range(len(self)) if self.line_starts[line_no + 1] > self.line_starts[line_no]])
+        self.char_starts = array.array(typecode, [0])
+        self.char_starts.extend(itertools.accumulate(map(operator.sub, self.token_ends, self.token_starts)))
+
+    def __len__(self):
+        return len(self.line_starts) - 1
+
+    def __getitem__(self, line_no):
+        if line_no < 0:
+            line_no += len(self)
+        if line_no < 0 or line_no >= len(self):
+            raise IndexError("line index out of range")
+        text = self.text
+        starts = self.token_starts
+        ends = self.token_ends
+        return [text[starts[i]:ends[i]] for i in
+                range(self.line_starts[line_no], self.line_starts[line_no + 1])]
+
+    def __iter__(self):
+        for line_no in range(len(self)):
+            yield self[line_no]
+
+    def num_tokens(self, line_no):
+        return self.line_starts[line_no + 1] - self.line_starts[line_no]
+
+    def token_length(self, line_no, token_no):
+        index = self.line_starts[line_no] + token_no
+        return self.token_ends[index] - self.token_starts[index]
+
+    def line_text(self, line_no):
+        return self.text[self.line_offsets[line_no]:self.line_offsets[line_no + 1] - 1]
+
+    def total_tokens(self):
+        return len(self.token_starts)
+
+    def total_chars(self):
+        return self.char_starts[-1]
+
+    def token_index(self, line_no, token_no):
+        return self.line_starts[line_no] + token_no
+
+    def token_line(self, index):
+        # The line with a given token is the last to start at or before it
+        # (earlier blank lines start at the same place).
+        return bisect.bisect_right(self.line_starts, index) - 1
+
+    def token_at(self, index):
+        line_no = self.token_line(index)
+        return (line_no, index - self.line_starts[line_no])
+
+    def char_index(self, line_no, token_no, char_no):
+        return self.char_starts[self.token_index(line_no, token_no)] + char_no
+
+    def char_at(self, index):
+        token = bisect.bisect_right(self.char_starts, index) - 1
+        line_no, token_no = self.token_at(token)
+        return (line_no, token_no, index - self.char_starts[token])
+
+    def memory_size(self):
+        arrays = [self.line_starts, self.line_offsets, self.token_starts,
+                self.token_ends, self.nonblank_lines, self.char_starts]
+        return sys.getsizeof(self.text) + sum(values.itemsize * len(values) for values in arrays)
+
+class StoredLines(object):
+    """The lines of a TokenStore's text, as a read-only list of strings."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, line_no):
+        if line_no < 0:
+            line_no += len(self.store)
+        if line_no < 0 or line_no >= len(self.store):
+            raise IndexError("line index out of range")
+        return self.store.line_text(line_no)
+
+    def __iter__(self):
+        for line_no in range(len(self.store)):
+            yield self.store.line_text(line_no)
+
 class Document(object):
-    """Storage for the raw text data."""
+    """Storage for the raw text data.
+
+    With lazy set, the file is memory-mapped and lines are only read and
+    tokenised when they are used (see MappedLines). Otherwise the whole file
+    is read and tokenised up front."""
     # TODO: Think about maintaining whitespace variations, probably just by
     # removing the .strip() below and then adjusting token selection to skip
     # blank tokens
 
-    def __init__(self, filename):
-        self.raw_text = open(filename).read()
-        self.lines = self.raw_text.split("\n")
-        self.search_cache = {}
-
-        self.tokens = []
+    def __init__(self, filename, lazy=False):
+        self.search = SearchIndex(self)
         self.first_char = None
         self.last_char = None
-        for line in self.raw_text.split("\n"):
-            cur = []
-            self.tokens.append(cur)
-            for token in line.strip().split():
-                if self.first_char is None:
-                    self.first_char = (len(self.tokens) - 1, 0, 0)
-                self.last_char = (len(self.tokens) - 1, len(cur), len(token) - 1)
-                cur.append(token)
+
+        # Only set when the whole document is tokenised
+        self.store = None
+
+        if lazy:
+            self.raw_text = None
+            self.lines = MappedLines(filename)
+            self.tokens = TokenisedLines(self.lines)
+            for line_no in range(len(self.tokens)):
+                if len(self.tokens[line_no]) > 0:
+                    self.first_char = (line_no, 0, 0)
+                    break
+            for line_no in range(len(self.tokens) - 1, -1, -1):
+                cur = self.tokens[line_no]
+                if len(cur) > 0:
+                    self.last_char = (line_no, len(cur) - 1, len(cur[-1]) - 1)
+                    break
+        else:
+            self.raw_text = open(filename).read()
+            self.tokens = TokenStore(self.raw_text)
+            self.lines = StoredLines(self.tokens)
+            self.store = self.tokens
+            total = self.store.total_tokens()
+            if total > 0:
+                self.first_char = self.store.token_at(0) + (0,)
+                self.last_char = self.store.char_at(self.store.total_chars() - 1)
         assert self.first_char is not None, "Empty document: {}".format(filename)
 
+    def memory_size(self):
+        """An estimate of the bytes in use, for deciding what to cache."""
+        if self.store is not None:
+            size = self.store.memory_size()
+        else:
+            size = self.lines.memory_size() + self.tokens.memory_size()
+        return size + self.search.memory_size()
+
     def valid_pos(self, pos):
         if len(pos) == 0:
             return True
@@ -103,17 +367,17 @@ class Document(object):
         line = pos[0]
         if line < 0 or line >= len(self.tokens):
             return False
-        if len(self.tokens[line]) == 0:
+        if self.tokens.num_tokens(line) == 0:
             return False
         # Check token
         if len(pos) >= 2:
             tok = pos[1]
-            if tok < 0 or tok >= len(self.tokens[line]):
+            if tok < 0 or tok >= self.tokens.num_tokens(line):
                 return False
             # Check character
             if len(pos) == 3:
                 char = pos[2]
-                if char < 0 or char >= len(self.tokens[line][tok]):
+                if char < 0 or char >= self.tokens.token_length(line, tok):
                     return False
         return True
 
@@ -128,41 +392,133 @@ class Document(object):
 
             token = 0
             if len(partial) == 1 and (not start):
-                token = len(self.tokens[line]) - 1
+                token = self.tokens.num_tokens(line) - 1
             elif len(partial) == 2:
                 token = partial[1]
 
             char = 0
             if not start:
-                char = len(self.tokens[line][token]) - 1
+                char = self.tokens.token_length(line, token) - 1
 
             return (line, token, char)
 
-    def matches(self, text):
-        if text not in self.search_cache:
-            positions = []
-            self.search_cache[text] = positions
-            for line_no, line in enumerate(self.lines):
-                if text in line:
-                    parts = line.split(text)
-                    ctoken, cchar = 0, 0
-                    options = []
-                    for part in parts[:-1]:
-                        # Advance
-                        for char in part:
-                            if char == ' ':
-                                ctoken += 1
-                                cchar = 0
-                            else:
-                                cchar += 1
-                        positions.append((line_no, ctoken, cchar))
-                        for char in text:
-                            if char == ' ':
-                                ctoken += 1
-                                cchar = 0
-                            else:
-                                cchar += 1
-        return self.search_cache[text]
+    def span_bounds(self, span):
+        """The first and last character of a span. These are offsets into the
+        text when the whole document is stored, and (line, token, character)
+        otherwise, either of which sort in document order."""
+        store = self.store
+        if store is not None and len(span.start) == 2:
+            # The first character of the first token, and the one before the
+            # token after the last
+            first = store.token_index(*span.start)
+            last = store.token_index(*span.end)
+            return store.char_starts[first], store.char_starts[last + 1] - 1
+        start = self.get_3tuple(span.start, True)
+        end = self.get_3tuple(span.end, False)
+        if store is not None:
+            return store.char_index(*start), store.char_index(*end)
+        return start, end
+
+    def matches(self, text, regex=False):
+        return self.search.matches(text, regex)
+
+    def _move_lines(self, line, shift, skip_blank):
+        """Shift a line number, staying within the lines that have tokens."""
+        first = self.first_char[0]
+        last = self.last_char[0]
+        delta = 1 if shift > 0 else -1
+        if shift == 0 or not (first <= line + delta <= last):
+            return line
+
+        if self.store is not None:
+            if not skip_blank:
+                return min(line + shift, last) if shift > 0 else max(line + shift, first)
+            # Count using the rank of lines that have tokens
+            nonblank = self.store.nonblank_lines
+            if shift > 0:
+                target = bisect.bisect_right(nonblank, line) + shift - 1
+                return nonblank[target] if target < len(nonblank) else last
+            else:
+                target = bisect.bisect_left(nonblank, line) + shift
+                return nonblank[target] if target >= 0 else first
+
+        # Shift incrementally so we can optionally only count lines that have
+        # tokens.
+        while shift != 0 and first <= line + delta <= last:
+            line += delta
+            if (not skip_blank) or self.tokens.num_tokens(line) > 0:
+                shift -= delta
+        return line
+
+    def _move_tokens(self, nline, ntok, shift):
+        """Shift a token, moving across lines and stopping at the ends."""
+        if self.store is not None and 0 <= ntok < self.tokens.num_tokens(nline):
+            index = self.store.token_index(nline, ntok) + shift
+            index = max(0, min(self.store.total_tokens() - 1, index))
+            return self.store.token_at(index)
+
+        delta = 1 if shift > 0 else -1
+        while shift != 0:
+            if delta == -1 and nline == self.first_char[0] and ntok == self.first_char[1]:
+                break
+            if delta == 1 and nline == self.last_char[0] and ntok == self.last_char[1]:
+                break
+            if 0 <= ntok + delta < self.tokens.num_tokens(nline):
+                ntok += delta
+            else:
+                # Go forward/back to a line with tokens. Note, we know
+                # there are later/earlier lines, since otherwise we
+                # would have been at the last_char/first_char
+                # position.
+                nline += delta
+                while self.tokens.num_tokens(nline) == 0:
+                    nline += delta
+                ntok = 0 if delta > 0 else self.tokens.num_tokens(nline) - 1
+            shift -= delta
+        return (nline, ntok)
+
+    def _move_chars(self, nline, ntok, nchar, shift):
+        """Shift a character, moving across tokens and lines and stopping at
+        the ends."""
+        if self.store is not None and 0 <= ntok < self.tokens.num_tokens(nline) and \
+                0 <= nchar < self.tokens.token_length(nline, ntok):
+            index = self.store.char_index(nline, ntok, nchar) + shift
+            index = max(0, min(self.store.total_chars() - 1, index))
+            return self.store.char_at(index)
+
+        delta = 1 if shift > 0 else -1
+        while shift != 0:
+            if delta == -1 and \
+                    nline == self.first_char[0] and \
+                    ntok == self.first_char[1] and \
+                    nchar == self.first_char[2]:
+                break
+            if delta == 1 and \
+                    nline == self.last_char[0] and \
+                    ntok == self.last_char[1] and \
+                    nchar == self.last_char[2]:
+                break
+            if 0 <= nchar + delta < self.tokens.token_length(nline, ntok):
+                nchar += delta
+            elif delta < 0 and ntok > 0:
+                ntok -= 1
+                nchar = self.tokens.token_length(nline, ntok) - 1
+            elif delta > 0 and ntok < self.tokens.num_tokens(nline) - 1:
+                ntok += 1
+                nchar = 0
+            else:
+                # Go forward/back to a line with tokens. Note, we know
+                # there are later/earlier lines, since otherwise we
+                # would have been at the last_char/first_char
+                # position.
+                if nline + delta <= self.last_char[0]:
+                    nline += delta
+                    while self.tokens.num_tokens(nline) == 0:
+                        nline += delta
+                    ntok = 0 if delta > 0 else self.tokens.num_tokens(nline) - 1
+                    nchar = 0 if delta > 0 else self.tokens.token_length(nline, ntok) - 1
+            shift -= delta
+        return (nline, ntok, nchar)
 
     def get_moved_pos(self, pos, right=0, down=0, maxjump=False, skip_blank=True):
         """Calculate a shifted version of a given position in this document.
@@ -183,14 +539,7 @@ class Document(object):
                 if down < 0: npos = self.first_char[0]
                 elif down > 0: npos = self.last_char[0]
             else:
-                # Shift incrementally so we can optionally only count lines
-                # that have tokens.
-                shift = down
-                delta = 1 if shift > 0 else -1
-                while shift != 0 and self.first_char[0] <= npos + delta <= self.last_char[0]:
-                    npos += delta
-                    if (not skip_blank) or len(self.tokens[npos]) > 0:
-                        shift -= delta
+                npos = self._move_lines(npos, down, skip_blank)
 
             return (npos,)
         elif len(pos) == 2: # Moving a token
@@ -204,40 +553,15 @@ class Document(object):
                 if down < 0: nline = self.first_char[0]
                 elif down > 0: nline = self.last_char[0]
             else:
-                # Shift incrementally so we can optionally only count lines
-                # that have tokens.
-                shift = down
-                delta = 1 if shift > 0 else -1
-                while shift != 0 and self.first_char[0] <= nline + delta <= self.last_char[0]:
-                    nline += delta
-                    if (not skip_blank) or len(self.tokens[nline]) > 0:
-                        shift -= delta
+                nline = self._move_lines(nline, down, skip_blank)
 
             # Horizontal movement
-            ntok = min(ntok, len(self.tokens[nline]) - 1)
+            ntok = min(ntok, self.tokens.num_tokens(nline) - 1)
             if maxjump:
                 if right < 0: ntok = 0
-                elif right > 0: ntok = len(self.tokens[nline]) - 1
-            else:
-                shift = right
-                delta = 1 if shift > 0 else -1
-                while shift != 0:
-                    if delta == -1 and nline == self.first_char[0] and ntok == self.first_char[1]:
-                        break
-                    if delta == 1 and nline == self.last_char[0] and ntok == self.last_char[1]:
-                        break
-                    if 0 <= ntok + delta < len(self.tokens[nline]):
-                        ntok += delta
-                    else:
-                        # Go forward/back to a line with tokens. Note, we know
-                        # there are later/earlier lines, since otherwise we
-                        # would have been at the last_char/first_char
-                        # position.
-                        nline += delta
-                        while len(self.tokens[nline]) == 0:
-                            nline += delta
-                        ntok = 0 if delta > 0 else len(self.tokens[nline]) - 1
-                    shift -= delta
+                elif right > 0: ntok = self.tokens.num_tokens(nline) - 1
+            elif right != 0:
+                nline, ntok = self._move_tokens(nline, ntok, right)
             return (nline, ntok)
         else: # Moving a character
             # Vertical movement
@@ -248,59 +572,20 @@ class Document(object):
                 if down < 0: nline = self.first_char[0]
                 elif down > 0: nline = self.last_char[0]
             else:
-                # Shift incrementally because we only want to count lines that
-                # have characters.
-                shift = down
-                delta = 1 if shift > 0 else -1
-                while shift != 0 and self.first_char[0] <= nline + delta <= self.last_char[0]:
-                    nline += delta
-                    if (not skip_blank) or len(self.tokens[nline]) > 0:
-                        shift -= delta
+                nline = self._move_lines(nline, down, skip_blank)
 
             # Horizontal movement
-            ntok = min(len(self.tokens[nline]) - 1, pos[1])
-            nchar = min(len(self.tokens[nline][ntok]) - 1, pos[2])
+            ntok = min(self.tokens.num_tokens(nline) - 1, pos[1])
+            nchar = min(self.tokens.token_length(nline, ntok) - 1, pos[2])
             if maxjump:
                 if right < 0:
                     ntok = 0
                     nchar = 0
                 elif right > 0:
-                    ntok = len(self.tokens[nline]) - 1
-                    nchar = len(self.tokens[nline][ntok]) - 1
-            else:
-                shift = right
-                delta = 1 if shift > 0 else -1
-                while shift != 0:
-                    if delta == -1 and \
-                            nline == self.first_char[0] and \
-                            ntok == self.first_char[1] and \
-                            nchar == self.first_char[1]:
-                        break
-                    if delta == 1 and \
-                            nline == self.last_char[0] and \
-                            ntok == self.last_char[1] and \
-                            nchar == self.last_char[1]:
-                        break
-                    if 0 <= nchar + delta < len(self.tokens[nline][ntok]):
-                        nchar += delta
-                    elif delta < 0 and ntok > 0:
-                        ntok -= 1
-                        nchar = len(self.tokens[nline][ntok]) - 1
-                    elif delta > 0 and ntok < len(self.tokens[nline]) - 1:
-                        ntok += 1
-                        nchar = 0
-                    else:
-                        # Go forward/back to a line with tokens. Note, we know
-                        # there are later/earlier lines, since otherwise we
-                        # would have been at the last_char/first_char
-                        # position.
-                        if nline + delta <= self.last_char[0]:
-                            nline += delta
-                            while len(self.tokens[nline]) == 0:
-                                nline += delta
-                            ntok = 0 if delta > 0 else len(self.tokens[nline]) - 1
-                            nchar = 0 if delta > 0 else len(self.tokens[nline][ntok]) - 1
-                    shift -= delta
+                    ntok = self.tokens.num_tokens(nline) - 1
+                    nchar = self.tokens.token_length(nline, ntok) - 1
+            elif right != 0:
+                nline, ntok, nchar = self._move_chars(nline, ntok, nchar, right)
             return (nline, ntok, nchar)
 
     def get_next_pos(self, pos):
@@ -319,6 +604,74 @@ class Document(object):
         else:
             return self.get_moved_pos(pos, -1, 0)
 
+    def get_stepped_pos(self, pos, steps):
+        """The position reached by calling get_next_pos (or, for negative
+        steps, get_previous_pos) steps times."""
+        if len(pos) == 1:
+            return self.get_moved_pos(pos, 0, steps)
+        return self.get_moved_pos(pos, steps, 0)
+
+    def get_distance(self, start, end):
+        """The number of calls to get_next_pos that go from start to end,
+        which must not be before it."""
+        if len(start) == 0:
+            return 0
+        if self.store is not None and len(start) == len(end) and \
+                self.valid_pos(start) and self.valid_pos(end):
+            if len(start) == 1:
+                nonblank = self.store.nonblank_lines
+                return bisect.bisect_left(nonblank, end[0]) - bisect.bisect_left(nonblank, start[0])
+            elif len(start) == 2:
+                return self.store.token_index(*end) - self.store.token_index(*start)
+            else:
+                return self.store.char_index(*end) - self.store.char_index(*start)
+        steps = -1
+        for _ in self.iter_positions(start, end):
+            steps += 1
+        return steps
+
+    def iter_positions(self, start, end):
+        """Yields every position from start to end (inclusive), in order.
+
+        This is the same as repeatedly calling get_next_pos, but when the
+        document has a TokenStore it walks ranges of token / character
+        numbers directly."""
+        if self.store is None or len(start) == 0 or len(start) != len(end) or \
+                end < start or not (self.valid_pos(start) and self.valid_pos(end)):
+            pos = start
+            while True:
+                yield pos
+                if pos == end:
+                    break
+                pos = self.get_next_pos(pos)
+            return
+
+        store = self.store
+        if len(start) == 1:
+            yield start
+            nonblank = store.nonblank_lines
+            lo = bisect.bisect_right(nonblank, start[0])
+            hi = bisect.bisect_right(nonblank, end[0])
+            for line in nonblank[lo:hi]:
+                yield (line,)
+            return
+
+        line_starts = store.line_starts
+        line = start[0]
+        first = store.token_index(start[0], start[1])
+        last = store.token_index(end[0], end[1])
+        for index in range(first, last + 1):
+            while index >= line_starts[line + 1]:
+                line += 1
+            token = index - line_starts[line]
+            if len(start) == 2:
+                yield (line, token)
+            else:
+                first_char = start[2] if index == first else 0
+                last_char = end[2] if index == last else store.token_ends[index] - store.token_starts[index] - 1
+                for char in range(first_char, last_char + 1):
+                    yield (line, token, char)
+
 ###class SpanCompare(Enum):
 ###  smaller = 0
 ###  smaller_left = 1
@@ -396,10 +749,33 @@ span_compare_le = {
     "smaller_one_one"
 }
 
+def compare_bounds(start, end, starts, ends):
+    """The SpanCompare value for the span from start to end against each of
+    the spans with the given starts and ends, all from the same document's
+    span_bounds."""
+    s0e0 = (start < end) - (start > end)
+    ans = []
+    for s1, e1 in zip(starts, ends):
+        ans.append(value_from_comparisons[
+            (start < s1) - (start > s1),
+            (end < e1) - (end > e1),
+            (start < e1) - (start > e1),
+            (end < s1) - (end > s1),
+            s0e0,
+            (s1 < e1) - (s1 > e1),
+        ])
+    return ans
+
 class Span(object):
     """A continuous span of text.
     
-    All annotations are on spans, some of which just happen to have a single element."""
+    All annotations are on spans, some of which just happen to have a single element.
+
+    Spans must not be changed once made. Comparisons and hashing use a key
+    worked out once, (start, end), which orders the same way as comparing
+    positions element by element, since all spans in a document have the
+    same scope."""
+    __slots__ = ('start', 'end', 'doc', 'scope', 'key')
 
     def __init__(self, scope, doc, span=None):
         self.start = None
@@ -451,9 +827,13 @@ class Span(object):
                 self.start = span.start
                 self.end = span.end
 
+        self.key = (self.start, self.end)
+
     def _compare_tuples(self, a, b):
         # Returns a number that is the kind of delta going from a to b
         # (positive, negative, or zero)
+        if len(a) == len(b):
+            return (a < b) - (a > b)
         if len(a) == 0 or len(b) == 0:
             return 0
         if a[0] == b[0]:
@@ -478,31 +858,22 @@ class Span(object):
             return -1
 
     def __hash__(self):
-        return hash((self.start, self.end))
+        return hash(self.key)
     def __eq__(self, other):
         if type(self) != type(other):
             return False
-        elif self._compare_tuples(self.start, other.start) != 0:
-            return False
-        elif self._compare_tuples(self.end, other.end) != 0:
-            return False
-        else:
-            return True
+        return self.key == other.key
     def __lt__(self, other):
-        assert type(self) == type(other)
-        comp = self._compare_tuples(self.start, other.start)
-        if comp == 0:
-            return self._compare_tuples(self.end, other.end) == 1
-        return comp == 1
+        return self.key < other.key
 
     def __ne__(self, other):
         return not self.__eq__(other)
     def __le__(self, other):
-        return self.__lt__(other) or self.__eq__(other)
+        return self.key <= other.key
     def __gt__(self, other):
-        return not self.__le__(other)
+        return self.key > other.key
     def __ge__(self, other):
-        return not self.__lt__(other)
+        return self.key >= other.key
 
     def __repr__(self):
         return "Span({}, {})".format(self.start, self.end)
@@ -519,14 +890,23 @@ class Span(object):
         s1 = other.doc.get_3tuple(other.start, True)
         e1 = other.doc.get_3tuple(other.end, False)
 
-        s0s1 = self._compare_tuples(s0, s1)
-        s0e1 = self._compare_tuples(s0, e1)
-        e0s1 = self._compare_tuples(e0, s1)
-        e0e1 = self._compare_tuples(e0, e1)
-        s0e0 = self._compare_tuples(s0, e0)
-        s1e1 = self._compare_tuples(s1, e1)
-
-        return value_from_comparisons[s0s1, e0e1, s0e1, e0s1, s0e0, s1e1]
+        return value_from_comparisons[
+            (s0 < s1) - (s0 > s1),
+            (e0 < e1) - (e0 > e1),
+            (s0 < e1) - (s0 > e1),
+            (e0 < s1) - (e0 > s1),
+            (s0 < e0) - (s0 > e0),
+            (s1 < e1) - (s1 > e1),
+        ]
+
+    def compare_many(self, others):
+        '''Compares this span with each of several from the same document,
+        returning a list of SpanCompare values.'''
+        doc = self.doc
+        start, end = doc.span_bounds(self)
+        bounds = [doc.span_bounds(other) for other in others]
+        return compare_bounds(start, end,
+                [s for s, _ in bounds], [e for _, e in bounds])
 
     def to_3tuple(self):
         if self.scope == 'character':
@@ -535,18 +915,8 @@ class Span(object):
         end = self.doc.get_3tuple(end)
         return Span('character', self.doc, (start, end))
 
-    def search(self, query, direction=None, count=1, maxjump=False):
-        options = self.doc.matches(query)
-        logging.debug(options)
-        ans = None
-        for option in options:
-            comp = self._compare_tuples(self.start, option)
-            if comp < 0 and direction == 'previous':
-                ans = option
-            elif comp > 0:
-                if direction == 'next':
-                    ans = option
-                break
+    def search(self, query, direction=None, count=1, maxjump=False, regex=False):
+        ans = self.doc.search.find(self.start, query, direction, regex)
         if ans is None:
             return self
         else:
@@ -591,8 +961,9 @@ class Span(object):
             nstart = self.doc.get_moved_pos(new_start, right, down, maxjump)
             nend = self.doc.get_moved_pos(new_end, right, down, maxjump)
 ###            logging.debug("From {} and {} to {} and {}".format(self.start, self.end, nstart, nend))
-            # Only move if it will change both (otherwise it is a shift).
-            if nstart != self.start and nend != self.end:
+            # Only move if it will change both (otherwise it is a shift), and
+            # not if hitting the edge of the document would turn it inside out.
+            if nstart != self.start and nend != self.end and nstart <= nend:
                 new_start = nstart
                 new_end = nend
         else:
@@ -625,6 +996,8 @@ class Item(object):
     """One or more spans and a set of labels.
 
     This is used in Datum to keep track of annotations, and used in View to determine the current appearance."""
+    __slots__ = ('doc', 'spans', 'labels')
+
     def __init__(self, doc, init_span=None, init_label=None):
         self.doc = doc
         self.spans = []
@@ -655,50 +1028,12 @@ class Item(object):
         return True
 
     def __str__(self):
-        labels = []
-        for label in self.labels:
-            labels.append(str(label))
-        labels = ' '.join(labels)
-
-        spans = '[' + ', '.join([str(s) for s in self.spans]) +']'
-        if len(self.spans) == 1:
-            spans = str(self.spans[0])
-            if self.spans[0].start == self.spans[0].end:
-                spans = str(self.spans[0].start)
-                if len(self.spans[0].start) == 1:
-                    spans = str(self.spans[0].start[0])
-        elif len(self.spans) > 1:
-            all_single = True
-            for s in self.spans:
-                if s.start != s.end:
-                    all_single = False
-            if all_single:
-                spans = str([s.start for s in self.spans])
-                if len(self.spans[0].start) == 1:
-                    spans = " ".join([str(s.start[0]) for s in self.spans])
-
-        return "{} - {}".format(spans, labels)
+        return format_line([(s.start, s.end) for s in self.spans], self.labels)
 
 def get_spans(text, doc, config):
     # TODO: allow for <filename>:data
-
-    spans = []
-    if text[0] in '[(':
-        spans = eval(text.strip())
-        if type(spans) == int:
-            spans = [(spans,)]
-        elif type(spans) == tuple:
-            spans = [spans]
-        elif type(spans) == list:
-            if len(spans) == 0:
-                spans = [()]
-            elif type(spans[0]) == int:
-                spans = [(s,) for s in spans]
-    else:
-        for num in text.split():
-            spans.append((int(num),))
-    
-    return [Span(config.annotation, doc, s) for s in spans]
+    value, _ = parse_literal(text)
+    return [Span(config.annotation, doc, s) for s in normalise_spans(value)]
 
 def get_labels(text, config):
     labels = set()
@@ -710,75 +1045,463 @@ def get_labels(text, config):
 
     return labels
 
+def make_item(config, doc, spans, labels, filename, line_no):
+    """An Item for spans and labels read from line_no of filename, checking
+    that they fit the document and annotation type."""
+    try:
+        spans = [Span(config.annotation, doc, s) for s in spans]
+    except AssertionError as e:
+        raise Exception("{}:{}: {}".format(filename, line_no, e))
+    for span in spans:
+        if not (doc.valid_pos(span.start) and (span.end is span.start or doc.valid_pos(span.end))):
+            raise Exception("{}:{}: {} is not a valid {} span for this document".format(filename, line_no, span, config.annotation))
+    if config.annotation_type == 'categorical':
+        labels = set(labels)
+    else:
+        assert len(labels) == 0, "{}:{}: unexpected labels".format(filename, line_no)
+        labels = set()
+    return Item(doc, spans, labels)
+
 def read_annotation_file(config, filename, doc):
     items = []
     if len(glob.glob(filename)) == 1:
-        for line in open(filename):
-            # Each line is:
-            # [spans] - [labels]
-            fields = line.strip().split()
-            spans = get_spans(line.split('-')[0], doc, config)
-            labels = get_labels('-'.join(line.split('-')[1:]), config)
-            items.append(Item(doc, spans, labels))
+        for line_no, spans, labels in iter_annotations(filename):
+            items.append(make_item(config, doc, spans, labels, filename, line_no))
         logging.info("Read {}".format(filename))
 
     return items
 
+def read_predictions_file(config, filename, doc):
+    """(item, confidence) pairs for the predictions in a file."""
+    predictions = []
+    for line_no, spans, labels, confidence in iter_predictions(filename):
+        item = make_item(config, doc, spans, labels, filename, line_no)
+        predictions.append((item, confidence))
+    logging.info("Read {} predictions from {}".format(len(predictions), filename))
+    return predictions
+
+class AnnotationIndex(object):
+    """The annotations for a document, indexed by span and position.
+
+    This behaves like the list of items it replaces (append, remove, iterate
+    in insertion order), but also supports finding items by their exact set
+    of spans, by any one of their spans, and by overlap with a range of the
+    document. Items must not have their spans changed while in the index
+    (labels can be changed freely)."""
+
+    def __init__(self, doc, items=None):
+        self.doc = doc
+        self.next_id = 0
+        self.item_ids = {}
+        self.items = {}
+        # (frozenset(spans), len(spans)) -> item ids
+        self.by_spans = {}
+        # span -> item ids
+        self.by_span = {}
+        # max(item.spans) -> count, and self-linked span -> count
+        self.last_spans = {}
+        self.self_links = {}
+        self.sorted_self_links = []
+        # Sorted (start, end, item id) entries using 3-tuple positions, plus
+        # a count of how many lines each entry covers so that overlap
+        # queries know how far back to look.
+        self.positions = []
+        self.line_extents = {}
+        self.max_line_extent = 0
+
+        if items is not None:
+            self.extend(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for item_id in sorted(self.items):
+            yield self.items[item_id]
+
+    def id_items(self):
+        for item_id in sorted(self.items):
+            yield item_id, self.items[item_id]
+
+    def get_id(self, item):
+        return self.item_ids[id(item)]
+
+    def _spans_key(self, spans):
+        return (frozenset(spans), len(spans))
+
+    def _get_items(self, ids):
+        return [self.items[item_id] for item_id in sorted(ids)]
+
+    def _span_entry(self, span, item_id):
+        start = self.doc.get_3tuple(span.start, True)
+        end = self.doc.get_3tuple(span.end, False)
+        return (start, end, item_id)
+
+    def append(self, item):
+        entries = []
+        self_links = []
+        self._add(item, entries, self_links)
+        for entry in entries:
+            bisect.insort(self.positions, entry)
+        for span in self_links:
+            bisect.insort(self.sorted_self_links, span)
+
+    def extend(self, items):
+        """Append several items, sorting the new positions once rather than
+        inserting them one at a time."""
+        entries = []
+        self_links = []
+        for item in items:
+            self._add(item, entries, self_links)
+        if len(entries) > 0:
+            self.positions.extend(entries)
+            self.positions.sort()
+        if len(self_links) > 0:
+            self.sorted_self_links.extend(self_links)
+            self.sorted_self_links.sort()
+
+    def _add(self, item, entries, self_links):
+        # Everything except the sorted lists, which get the new entries and
+        # self-linked spans added by the caller
+        item_id = self.next_id
+        self.next_id += 1
+        self.item_ids[id(item)] = item_id
+        self.items[item_id] = item
+
+        spans = item.spans
+        self.by_spans.setdefault(self._spans_key(spans), set()).add(item_id)
+        for span in spans:
+            self.by_span.setdefault(span, set()).add(item_id)
+            entry = self._span_entry(span, item_id)
+            entries.append(entry)
+            extent = entry[1][0] - entry[0][0]
+            self.line_extents[extent] = self.line_extents.get(extent, 0) + 1
+            if extent > self.max_line_extent:
+                self.max_line_extent = extent
+
+        if len(spans) > 0:
+            last = spans[0] if len(spans) == 1 else max(spans)
+            self.last_spans[last] = self.last_spans.get(last, 0) + 1
+            if len(spans) == 1 or last == min(spans):
+                if last not in self.self_links:
+                    self.self_links[last] = 0
+                    self_links.append(last)
+                self.self_links[last] += 1
+
+    def remove(self, item):
+        item_id = self.item_ids.pop(id(item))
+        del self.items[item_id]
+
+        key = self._spans_key(item.spans)
+        self.by_spans[key].discard(item_id)
+        if len(self.by_spans[key]) == 0:
+            del self.by_spans[key]
+        for span in item.spans:
+            ids = self.by_span.get(span)
+            if ids is not None:
+                ids.discard(item_id)
+                if len(ids) == 0:
+                    del self.by_span[span]
+            entry = self._span_entry(span, item_id)
+            pos = bisect.bisect_left(self.positions, entry)
+            if pos < len(self.positions) and self.positions[pos] == entry:
+                del self.positions[pos]
+            extent = entry[1][0] - entry[0][0]
+            self.line_extents[extent] -= 1
+            if self.line_extents[extent] == 0:
+                del self.line_extents[extent]
+                if extent == self.max_line_extent:
+                    self.max_line_extent = max(self.line_extents) if len(self.line_extents) > 0 else 0
+
+        if len(item.spans) > 0:
+            last = max(item.spans)
+            self.last_spans[last] -= 1
+            if self.last_spans[last] == 0:
+                del self.last_spans[last]
+            if last == min(item.spans):
+                self.self_links[last] -= 1
+                if self.self_links[last] == 0:
+                    del self.self_links[last]
+                    pos = bisect.bisect_left(self.sorted_self_links, last)
+                    del self.sorted_self_links[pos]
+
+    def with_spans(self, spans):
+        """Items whose spans are exactly the given spans."""
+        return self._get_items(self.by_spans.get(self._spans_key(spans), ()))
+
+    def with_any_span(self, spans):
+        """Items that have at least one of the given spans."""
+        ids = set()
+        for span in spans:
+            ids.update(self.by_span.get(span, ()))
+        return self._get_items(ids)
+
+    def overlapping(self, span):
+        """Items with a span that shares a position with the given span."""
+        start = self.doc.get_3tuple(span.start, True)
+        end = self.doc.get_3tuple(span.end, False)
+        lo = bisect.bisect_left(self.positions, ((start[0] - self.max_line_extent,),))
+        hi = bisect.bisect_right(self.positions, (end + (float('inf'),),))
+        ids = set()
+        for entry_start, entry_end, item_id in self.positions[lo:hi]:
+            if entry_end >= start:
+                ids.add(item_id)
+        return self._get_items(ids)
+
+    def is_last_span(self, span):
+        """True if the span is the last span of some item."""
+        return span in self.last_spans
+
+    def next_self_link(self, span, direction):
+        """The closest self-linked span after (or before) the given span."""
+        if direction == 'next':
+            pos = bisect.bisect_right(self.sorted_self_links, span)
+            if pos < len(self.sorted_self_links):
+                return self.sorted_self_links[pos]
+        else:
+            pos = bisect.bisect_left(self.sorted_self_links, span)
+            if pos > 0:
+                return self.sorted_self_links[pos - 1]
+        return None
+
+def span_positions(doc, span):
+    """Yields (position, is_space) for every position in a span.
+
+    Spaces are the gaps between tokens, which are marked with a character
+    number of -1 so that they can be coloured as part of the span."""
+    first = True
+    for pos in doc.iter_positions(span.start, span.end):
+        # Handle the case of a space
+        if (not first) and (len(pos) == 2 or (len(pos) == 3 and pos[2] == 0)):
+            yield (pos[0], pos[1], -1), True
+        yield pos, False
+        first = False
+
+# Marks are strings ('cursor', 'link', 'ref', 'self-link', 'linked' and
+# labels) or, for other annotations being compared, tuples:
+#   ('compare', number of annotations without it, label)
+#   ('compare-ref', linked to the linking position, number without it, is the
+#    item's last span)
+# Each distinct tuple is only created once, so a frame's markings share them.
+_marks = {}
+
+def compare_mark(count, label):
+    mark = ('compare', count, label)
+    return _marks.setdefault(mark, mark)
+
+def compare_ref_mark(has_link, count, last):
+    mark = ('compare-ref', has_link, count, last)
+    return _marks.setdefault(mark, mark)
+
+class MarkingLayer(object):
+    """The parts of a Datum's markings that do not depend on the cursor.
+
+    Markings for annotations are stored per position and per item, so that
+    a single item can be added, removed or relabelled without recomputing
+    the rest. Markings for disagreements are computed once."""
+
+    def __init__(self, datum):
+        self.doc = datum.doc
+        self.config = datum.config
+        # pos -> {item id -> [marks]}
+        self.item_marks = {}
+        # pos -> [(disagreement number, [marks], (count, is last span) or
+        # None, is_space)]
+        self.disagreement_marks = {}
+        # span -> disagreement numbers
+        self.disagreement_spans = {}
+
+        for item_id, item in datum.annotations.id_items():
+            self.add_item(item_id, item)
+
+        for num, (item, count) in enumerate(datum.disagreements):
+            self._add_disagreement(num, item, count)
+
+    def _item_labels(self, item):
+        # Get the standard color for this item based on its label
+        base_labels = []
+        if self.config.annotation_type == 'categorical':
+            # For categorical use the configuration set
+            for key in item.labels:
+                if key in self.config.labels:
+                    base_labels.append(key)
+                else:
+                    base_labels.append("label:"+ key)
+        elif self.config.annotation_type == 'link':
+            # For links potentially indicate it is linked
+            if not self.config.args.do_not_show_linked:
+                base_labels.append('linked')
+        return base_labels
+
+    def add_item(self, item_id, item):
+        base_labels = self._item_labels(item)
+        for span in item.spans:
+            for pos, _ in span_positions(self.doc, span):
+                self.item_marks.setdefault(pos, {}).setdefault(item_id, []).extend(base_labels)
+
+    def remove_item(self, item_id, item):
+        for span in item.spans:
+            for pos, _ in span_positions(self.doc, span):
+                marks = self.item_marks.get(pos)
+                if marks is not None and item_id in marks:
+                    del marks[item_id]
+                    if len(marks) == 0:
+                        del self.item_marks[pos]
+
+    def _add_disagreement(self, num, item, count):
+        base_labels = []
+        if self.config.annotation_type == 'categorical':
+            for key in item.labels:
+                base_labels.append(compare_mark(count, key))
+
+        for span in item.spans:
+            self.disagreement_spans.setdefault(span, []).append(num)
+
+        max_span = max(item.spans)
+        for span in item.spans:
+            suffix = None
+            if len(item.spans) > 1:
+                suffix = (count, span == max_span)
+            for pos, is_space in span_positions(self.doc, span):
+                entry = (num, base_labels, suffix, is_space)
+                self.disagreement_marks.setdefault(pos, []).append(entry)
+
+class Markings(object):
+    """The markings for a single render, mapping positions to tuples of marks.
+
+    This combines the persistent MarkingLayer with the cursor, link and ref
+    overlays, which are the only parts computed per frame. Lookups are
+    composed on demand and remembered for the rest of the frame."""
+
+    def __init__(self, layer, overlay, linked_disagreements):
+        self.layer = layer
+        self.overlay = overlay
+        self.linked_disagreements = linked_disagreements
+        self.cache = {}
+
+    def __contains__(self, pos):
+        return pos in self.overlay or \
+                pos in self.layer.item_marks or \
+                pos in self.layer.disagreement_marks
+
+    def __getitem__(self, pos):
+        if pos in self.cache:
+            return self.cache[pos]
+        if pos not in self:
+            raise KeyError(pos)
+
+        front, back = self.overlay.get(pos, ((), ()))
+        ans = list(front)
+        item_marks = self.layer.item_marks.get(pos)
+        if item_marks is not None:
+            for item_id in sorted(item_marks):
+                ans.extend(item_marks[item_id])
+        ans.extend(back)
+        for num, base_labels, suffix, is_space in self.layer.disagreement_marks.get(pos, ()):
+            ans.extend(base_labels)
+            if suffix is not None:
+                has_link = num in self.linked_disagreements
+                if has_link or not is_space:
+                    ans.append(compare_ref_mark(has_link, suffix[0], suffix[1]))
+
+        ans = tuple(ans)
+        self.cache[pos] = ans
+        return ans
+
+    def get(self, pos, default=None):
+        ans = self.cache.get(pos)
+        if ans is not None:
+            return ans
+        if pos in self:
+            return self[pos]
+        return default
+
+    def keys(self):
+        keys = set(self.overlay)
+        keys.update(self.layer.item_marks)
+        keys.update(self.layer.disagreement_marks)
+        return keys
+
+    def items(self):
+        return [(pos, self[pos]) for pos in self.keys()]
+
+# Approximate sizes (in CPython) used by Datum.memory_size. These are the
+# bytes left allocated per annotation (read, or read and indexed) and per
+# position in the marking layer, measured with tracemalloc by
+# benchmarks/item_sizes.py on sparse and dense corpora (650, 1830 and 390
+# bytes with CPython 3.11 on 64-bit Linux), rounded up.
+ITEM_BYTES = 700
+INDEXED_ITEM_BYTES = 1900
+MARKED_POSITION_BYTES = 400
+
 class Datum(object):
     """Storage for a single file's data and annotations.
 
     Note, the structure of storage depends on the annotation type."""
 
-    def __init__(self, filename, config, output_file, other_annotation_files):
+    def __init__(self, filename, config, output_file, other_annotation_files, doc=None):
         self.filename = filename
         self.config = config
         self.output_file = output_file
-        self.doc = Document(filename)
+        # A Document may be passed in if it has already been read
+        if doc is None:
+            doc = Document(filename, config.args.lazy_load)
+        self.doc = doc
         logging.info("Reading data from "+ self.output_file)
-        self.annotations = read_annotation_file(config, self.output_file, self.doc)
+        self.annotations = AnnotationIndex(self.doc,
+                read_annotation_file(config, self.output_file, self.doc))
 
+        # Model predictions are compared like other annotations, and are
+        # also put in order of confidence for review
         self.other_annotation_files = other_annotation_files
         self.other_annotations = []
+        predictions = []
         for filename in other_annotation_files:
-            self.other_annotations.append(read_annotation_file(config, filename, self.doc))
+            if filename.endswith(PREDICTIONS_SUFFIX):
+                file_predictions = read_predictions_file(config, filename, self.doc)
+                predictions += file_predictions
+                self.other_annotations.append([item for item, _ in file_predictions])
+            else:
+                self.other_annotations.append(read_annotation_file(config, filename, self.doc))
+        self.review_queue = None
+        if len(predictions) > 0:
+            self.review_queue = ReviewQueue(self.annotations, predictions)
 
-        # Working this out is a once-off expensive process
-        self.disagreements = []
-        all_item_counts = {}
-        hash_to_item = {}
-        for annotations in self.other_annotations:
-            for item in annotations:
-                h = hash((tuple(item.spans), tuple(item.labels)))
-                hash_to_item[h] = item
-                if h not in all_item_counts:
-                    all_item_counts[h] = 0
-                all_item_counts[h] += 1
-        for h, count in all_item_counts.items():
-            self.disagreements.append((hash_to_item[h],len(self.other_annotations) - count))
+        # Built on first use, then kept up to date as annotations change
+        self.marking_layer = None
+
+        # Set by start_journal when edits are being made
+        self.journal = None
+
+        self.adjudication = Adjudication(self.other_annotations)
+        self.disagreements = self.adjudication.disagreements
 
     def get_next_self_link(self, cursor, linking_pos, direction, moving_link):
         if moving_link:
-            self_links = set()
-            for item in self.annotations:
-                if max(item.spans) == min(item.spans):
-                    self_links.add(min(item.spans))
-            position = linking_pos.edited(direction)
-            prev = None
-            while position != prev:
-                if position in self_links:
-                    return position
-                prev = position
-                position = position.edited(direction)
+            # Stepping a span moves both ends one position at a time (until
+            # the end of the document stops one of them), so skip over self
+            # links it would never land on.
+            doc = self.doc
+            start = linking_pos.start
+            end = linking_pos.end
+            position = self.annotations.next_self_link(linking_pos, direction)
+            while position is not None:
+                if direction == 'next':
+                    steps = doc.get_distance(start, position.start)
+                    if doc.get_stepped_pos(end, steps) == position.end:
+                        return position
+                elif position.end <= end:
+                    steps = doc.get_distance(position.end, end)
+                    if doc.get_stepped_pos(start, -steps) == position.start:
+                        return position
+                position = self.annotations.next_self_link(position, direction)
             return linking_pos
         else:
             return cursor
 
     def get_next_unannotated(self, cursor, linking_pos, direction, moving_link):
         if moving_link:
-            annotated = set()
-            for item in self.annotations:
-                span = max(item.spans)
-                annotated.add(span)
+            annotated = self.annotations.last_spans
             position = linking_pos.edited(direction)
             prev = None
             while position in annotated and position != prev:
@@ -791,246 +1514,211 @@ class Datum(object):
             return cursor
 
     def get_next_disagreement(self, cursor, linking_pos, direction, moving_link, cycle=True):
-        best = None
-        first = None
-        last = None
-        for item, count in self.disagreements:
-            if moving_link:
-                if count > 0:
-                    span = max(item.spans)
-                    if first is None or span > first:
-                        first = span
-                    if last is None or span < last:
-                        last = span
-                    if direction == 'next' and span > linking_pos:
-                        if best is None or span < best:
-                            best = span
-                    elif direction == 'previous' and span < linking_pos:
-                        if best is None or span > best:
-                            best = span
-            else:
-                has_link = False
-                for span in item.spans:
-                    if span == linking_pos:
-                        has_link = True
-                if has_link:
-                    for span in item.spans:
-                        if span <= linking_pos:
-                            if first is None or span < first:
-                                first = span
-                            if last is None or span > last:
-                                last = span
-                            if direction == 'next' and span > cursor:
-                                if best is None or span < best:
-                                    best = span
-                            elif direction == 'previous' and span < cursor:
-                                if best is None or span > best:
-                                    best = span
-        if best is None and cycle:
-            if direction == 'next':
-                best = first
-            else:
-                best = last
-        return best
+        return self.adjudication.next_disagreement(cursor, linking_pos, direction, moving_link, cycle)
+
+    def get_next_prediction(self, cursor, linking_pos, direction, moving_link):
+        """The least confident unreviewed prediction after (or before) the
+        one at the position being moved, or None if there are none left."""
+        if self.review_queue is None:
+            return None
+        if moving_link:
+            return self.review_queue.next_prediction(linking_pos, direction, True)
+        return self.review_queue.next_prediction(cursor, direction)
 
     def get_overlapping_spans(self, cursor):
-        ans = []
+        return self.annotations.overlapping(cursor)
 
-        # Set colors for cursor and linking pos
-        for item in self.annotations:
-            matched = False
-            cpos = cursor.start
-            while True:
-                for span in item.spans:
-                    pos = span.start
-                    while True:
-                        if pos == cpos:
-                            matched = True
-                            break
-                        if pos == span.end:
-                            break
-                        pos = self.doc.get_next_pos(pos)
-                    if matched:
-                        break
-                if matched:
-                    break
-                if cpos == cursor.end:
-                    break
-                cpos = self.doc.get_next_pos(cpos)
-            if matched:
-                ans.append(item)
-        return ans
+    def memory_size(self):
+        """An estimate of the bytes in use, for deciding what to cache."""
+        items = len(self.annotations) * INDEXED_ITEM_BYTES
+        for annotations in self.other_annotations:
+            items += len(annotations) * ITEM_BYTES
+        marks = 0
+        if self.marking_layer is not None:
+            marks = len(self.marking_layer.item_marks) + len(self.marking_layer.disagreement_marks)
+        return self.doc.memory_size() + items + marks * MARKED_POSITION_BYTES
+
+    def get_marking_layer(self):
+        if self.marking_layer is None:
+            self.marking_layer = MarkingLayer(self)
+        return self.marking_layer
 
     def get_all_markings(self, cursor, linking_pos):
-        ans = {}
+        layer = self.get_marking_layer()
+
+        # pos -> (marks before item marks, marks after item marks)
+        overlay = {}
+        def add_overlay(pos, mark, front=True):
+            cur = overlay.setdefault(pos, ([], []))
+            cur[0 if front else 1].append(mark)
 
         # Set colors for cursor and linking pos
-        pos = cursor.start
-        while True:
-            ans.setdefault(pos, []).append('cursor')
-            if pos == cursor.end:
-                break
-            pos = self.doc.get_next_pos(pos)
-            # Handle the case of a space
-            if len(pos) == 2 or (len(pos) == 3 and pos[2] == 0):
-                ans.setdefault((pos[0], pos[1], -1), []).append('cursor')
+        for pos, _ in span_positions(self.doc, cursor):
+            add_overlay(pos, 'cursor')
         if linking_pos is not None:
-            pos = linking_pos.start
-            while True:
-                ans.setdefault(pos, []).append('link')
-                if pos == linking_pos.end:
-                    break
-                pos = self.doc.get_next_pos(pos)
-                # Handle the case of a space
-                if len(pos) == 2 or (len(pos) == 3 and pos[2] == 0):
-                    ans.setdefault((pos[0], pos[1], -1), []).append('link')
-
-        # Set item colors
-        for item in self.annotations:
-            # Get the standard color for this item based on its label
-            base_labels = []
-            if self.config.annotation_type == 'categorical':
-                # For categorical use the configuration set
-                for key in item.labels:
-                    if key in self.config.labels:
-                        base_labels.append(key)
-                    else:
-                        base_labels.append("label:"+ key)
-            elif self.config.annotation_type == 'link':
-                # For links potentially indicate it is linked
-                if not self.config.args.do_not_show_linked:
-                    base_labels.append('linked')
-            
-            is_self_link = len(item.spans) == 2 and item.spans[0] == item.spans[1]
-
-            has_link = False
-            for span in item.spans:
-                if span == linking_pos:
-                    has_link = True
-
-            for span in item.spans:
-                pos = span.start
-                while True:
-                    cur = ans.setdefault(pos, [])
-                    for label in base_labels:
-                        cur.append(label)
-
-                    if len(item.spans) > 1 and has_link:
-                        cur.append('ref')
-                        if is_self_link:
-                            cur.append('self-link')
-
-                    if pos == span.end:
-                        break
-                    pos = self.doc.get_next_pos(pos)
-                    # Handle the case of a space
-                    if len(pos) == 2 or (len(pos) == 3 and pos[2] == 0):
-                        cur = ans.setdefault((pos[0], pos[1], -1), [])
-                        for label in base_labels:
-                            cur.append(label)
-                        if len(item.spans) > 1 and has_link:
-                            cur.append('ref')
-
-        # Now do disagreement colours.
-        for item, count in self.disagreements:
-            # Get the standard color for this item based on its label
-            base_labels = []
-            if self.config.annotation_type == 'categorical':
-                for key in item.labels:
-                    if key in self.config.labels:
-                        base_labels.append("compare-{}-{}".format(count, key))
-                    else:
-                        base_labels.append("compare-label-{}-{}".format(count, key))
-            
-            has_link = False
-            for span in item.spans:
-                if span == linking_pos:
-                    has_link = True
-
-            ref_label = "compare-ref-{}-{}".format(has_link, count)
-            max_span = max(item.spans)
-            for span in item.spans:
-                pos = span.start
-                while True:
-                    cur = ans.setdefault(pos, [])
-                    for label in base_labels:
-                        cur.append(label)
-                        # TODO: Record the span too
-
-                    if len(item.spans) > 1:
-                        if span == max_span:
-                            cur.append(ref_label +"-last")
-                        else:
-                            cur.append(ref_label +"-earlier")
-
-                    if pos == span.end:
-                        break
-                    pos = self.doc.get_next_pos(pos)
-                    # Handle the case of a space
-                    if len(pos) == 2 or (len(pos) == 3 and pos[2] == 0):
-                        cur = ans.setdefault((pos[0], pos[1], -1), [])
-                        for label in base_labels:
-                            cur.append(label)
-                        if len(item.spans) > 1 and has_link:
-                            if span == max_span:
-                                cur.append(ref_label +"-last")
-                            else:
-                                cur.append(ref_label +"-earlier")
+            for pos, _ in span_positions(self.doc, linking_pos):
+                add_overlay(pos, 'link')
 
-        return ans
+        # Mark items that are linked to the linking pos
+        linked_disagreements = set()
+        if linking_pos is not None:
+            for item in self.annotations.with_any_span([linking_pos]):
+                if len(item.spans) < 2:
+                    continue
+                is_self_link = len(item.spans) == 2 and item.spans[0] == item.spans[1]
+                for span in item.spans:
+                    for pos, is_space in span_positions(self.doc, span):
+                        add_overlay(pos, 'ref', False)
+                        if is_self_link and not is_space:
+                            add_overlay(pos, 'self-link', False)
+            linked_disagreements.update(layer.disagreement_spans.get(linking_pos, ()))
+
+        return Markings(layer, overlay, linked_disagreements)
 
     def next_match(self, span, text, reverse=False):
         return self.doc.next_match(span, text, reverse)
 
     def get_item_with_spans(self, spans, any_present=False):
-        items = []
-        for item in self.annotations:
-            match = 0
-            for span in item.spans:
-                if span in spans:
-                    match += 1
-            rev_match = 0
-            for span in spans:
-                if span in item.spans:
-                    rev_match += 1
-            if len(item.spans) == len(spans) == match == rev_match:
-                items.append(item)
-            elif any_present and match > 0:
-                items.append(item)
-        return items
+        if any_present:
+            return self.annotations.with_any_span(spans)
+        return self.annotations.with_spans(spans)
+
+    def _add_item(self, item):
+        self.annotations.append(item)
+        if self.marking_layer is not None:
+            self.marking_layer.add_item(self.annotations.get_id(item), item)
+        if self.review_queue is not None:
+            self.review_queue.mark_reviewed(item.spans)
+
+    def _remove_item(self, item):
+        if self.marking_layer is not None:
+            self.marking_layer.remove_item(self.annotations.get_id(item), item)
+        self.annotations.remove(item)
+        if self.review_queue is not None and len(self.annotations.with_spans(item.spans)) == 0:
+            self.review_queue.mark_unreviewed(item.spans)
+
+    def _relabel_item(self, item, add=None, remove=None):
+        item_id = self.annotations.get_id(item)
+        if self.marking_layer is not None:
+            self.marking_layer.remove_item(item_id, item)
+        if add is not None:
+            item.labels.add(add)
+        if remove is not None:
+            item.labels.remove(remove)
+        if self.marking_layer is not None:
+            self.marking_layer.add_item(item_id, item)
+
+    def start_journal(self):
+        """Log edits to a journal beside the output file, first applying
+        any edits left there by a session that did not end cleanly."""
+        journal = Journal(self.output_file + '.journal', self.output_file)
+        edits = journal.pending()
+        for action, spans, label in edits:
+            spans = [Span(self.config.annotation, self.doc, span) for span in spans]
+            if action == 'modify':
+                self.modify_annotation(spans, label)
+            else:
+                self.remove_annotation(spans)
+        if len(edits) > 0:
+            logging.info("Recovered {} edits from {}".format(len(edits), journal.filename))
+        journal.open()
+        self.journal = journal
+
+    def close_journal(self, remove=True):
+        if self.journal is not None:
+            self.journal.close(remove)
+            self.journal = None
+
+    def _record_edit(self, action, spans, label=None):
+        if self.journal is not None:
+            self.journal.record(action, spans, label)
+
+    def _compact_journal(self):
+        if self.journal is not None and self.journal.needs_compaction():
+            self.write_out()
+
+    def save(self):
+        """Make sure all edits so far are on disk. With a journal that only
+        needs the journal to be synced."""
+        if self.journal is not None:
+            self.journal.mark_saved()
+        else:
+            self.write_out()
+
+    def discard_unsaved(self):
+        """Stop editing, leaving the annotation file with the edits made up
+        to the last save and none of the ones after it."""
+        journal = self.journal
+        if journal is None:
+            return
+        if journal.saved_edits == journal.edits and journal.edits > 0:
+            self.write_out()
+        elif journal.saved_edits > 0:
+            # The saved edits are only in the journal, so apply them to the
+            # annotation file as it is on disk.
+            journal.drop_unsaved()
+            journal.close()
+            saved = Datum(self.filename, self.config, self.output_file,
+                    self.other_annotation_files, self.doc)
+            saved.start_journal()
+            saved.write_out()
+            saved.close_journal()
+        self.close_journal()
 
     def modify_annotation(self, spans, label=None):
+        self._record_edit('modify', spans, label)
+        self._modify_annotation(spans, label)
+        self._compact_journal()
+
+    def _modify_annotation(self, spans, label=None):
         # TODO: switch link to be like the old style
         to_edit = self.get_item_with_spans(spans)
         if len(to_edit) == 0:
             # No item with these spans exists, create it
             nspans = [Span(self.config.annotation, self.doc, s) for s in spans]
             item = Item(self.doc, nspans, label)
-            self.annotations.append(item)
+            self._add_item(item)
         else:
             for item in to_edit:
                 # Modify existing item
                 if label is None:
                     if len(item.labels) == 0:
-                        self.annotations.remove(item)
+                        self._remove_item(item)
                 elif label in item.labels:
-                    item.labels.remove(label)
-                    if len(item.labels) == 0:
-                        self.annotations.remove(item)
+                    if len(item.labels) == 1:
+                        item.labels.remove(label)
+                        self._remove_item(item)
+                    else:
+                        self._relabel_item(item, remove=label)
                 else:
-                    item.labels.add(label)
+                    self._relabel_item(item, add=label)
 
     def remove_annotation(self, spans):
+        self._record_edit('remove', spans)
         permissive = self.config.annotation_type == 'link'
         for item in self.get_item_with_spans(spans, permissive):
-            self.annotations.remove(item)
+            self._remove_item(item)
+        self._compact_journal()
 
     def write_out(self, filename=None):
         out_filename = self.output_file
         if filename is not None:
             out_filename = filename
-        out = open(out_filename, 'w')
-        for item in self.annotations:
-            print(str(item), file=out)
-        out.close()
+
+        # Write to a temporary file and move it into place, so a crash part
+        # way through never leaves a partial annotation file.
+        tmp_filename = out_filename + '.tmp'
+        if out_filename.endswith(BINARY_SUFFIX):
+            write_binary(tmp_filename, (([(s.start, s.end) for s in item.spans], item.labels)
+                for item in self.annotations))
+        else:
+            out = open(tmp_filename, 'w')
+            for item in self.annotations:
+                print(str(item), file=out)
+            out.close()
+        with open(tmp_filename, 'rb') as out:
+            os.fsync(out.fileno())
+        os.replace(tmp_filename, out_filename)
+        if self.journal is not None and out_filename == self.output_file:
+            self.journal.reset()
 
@@ -0,0 +1,388 @@
+from __future__ import print_function
+
+import argparse
+import array
+import json
+import mmap
+import re
+import struct
+import sys
+
+# Each line of an annotation file is:
+#   [spans] - [labels]
+# where the spans are either space separated line numbers or a Python-style
+# literal made of integers, tuples and lists, e.g.
+#   3
+#   (2, 1) - label:a
+#   ((3, 5), (3, 8)) - label:a label:b
+#   [((1, 0), (1, 2)), ((4, 1), (4, 1))] -
+#   13 0 -
+# These are parsed directly rather than with eval.
+
+_TOKEN = re.compile(r'\s*(?:(-?\d+)|([\[\](),])|(-)(?=\s|$))')
+_NUMBER = re.compile(r'\d+')
+
+# The forms written by Item.__str__ for single spans (and the older space
+# separated form for lines) are matched in one go, other lines are parsed a
+# token at a time.
+_POSITION = r'\(\s*(\d+(?:\s*,\s*\d+)*)\s*,?\s*\)'
+_STRICT_POSITION = r'\(\s*(\d+\s*,(?:\s*\d+\s*,)*(?:\s*\d+)?)\s*\)'
+_SIMPLE_LINE = re.compile(r'\s*(?:(\d+(?:\s+\d+)*)|' + _POSITION +
+        r'|\(\s*' + _STRICT_POSITION + r'\s*,\s*' + _STRICT_POSITION +
+        r'\s*,?\s*\))\s+-(?=\s|$)')
+
+def parse_literal(text, pos=0, stop_at_dash=False):
+    """Parse a literal of integers, tuples and lists starting at pos.
+
+    Returns the value and the position after it. With stop_at_dash, parsing
+    ends at a '-' separator, which is then included in the returned
+    position."""
+    # Each open group is [kind, values, number of values before the last
+    # comma], so that commas and values must alternate.
+    groups = []
+    values = []
+    while True:
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            if groups or text[pos:].strip():
+                raise ValueError("Unexpected text at {}: {}".format(pos, text[pos:].strip()))
+            break
+        pos = match.end()
+        number, symbol, dash = match.groups()
+        cur = groups[-1][1] if groups else values
+        if (number is not None or symbol in ('(', '[')) and groups and len(cur) != groups[-1][2]:
+            raise ValueError("Missing ',' at {}".format(match.start()))
+        if number is not None:
+            cur.append(int(number))
+        elif dash is not None:
+            if groups or not stop_at_dash:
+                raise ValueError("Unexpected '-' at {}".format(pos - 1))
+            break
+        elif symbol in ('(', '['):
+            groups.append([symbol, [], 0])
+        elif symbol == ',':
+            if not groups or len(cur) == groups[-1][2]:
+                raise ValueError("Unexpected ',' at {}".format(pos - 1))
+            groups[-1][2] = len(cur)
+        else:
+            if not groups or '(['.index(groups[-1][0]) != ')]'.index(symbol):
+                raise ValueError("Unbalanced '{}' at {}".format(symbol, pos - 1))
+            kind, group, commas = groups.pop()
+            if kind == '[':
+                value = group
+            elif len(group) == 1 and commas == 0:
+                value = group[0]
+            else:
+                value = tuple(group)
+            if groups:
+                groups[-1][1].append(value)
+            else:
+                values.append(value)
+
+    # Space separated numbers form a list, a single value stands alone.
+    if len(values) == 1:
+        return values[0], pos
+    return values, pos
+
+def normalise_spans(value):
+    """Convert a parsed literal into a list of position tuples or (start,
+    end) pairs, following the conventions of the annotation format."""
+    if type(value) == int:
+        return [(value,)]
+    elif type(value) == tuple:
+        return [value]
+    elif len(value) == 0:
+        return [()]
+    elif type(value[0]) == int:
+        return [(num,) for num in value]
+    return value
+
+def _numbers(text):
+    return tuple([int(num) for num in _NUMBER.findall(text)])
+
+def parse_line(line):
+    """Split one line of an annotation file into spans and labels."""
+    match = _SIMPLE_LINE.match(line)
+    if match is not None:
+        numbers, single, start, end = match.groups()
+        if numbers is not None:
+            spans = [(int(num),) for num in numbers.split()]
+        elif single is not None:
+            spans = [_numbers(single)]
+        else:
+            spans = [(_numbers(start), _numbers(end))]
+        return spans, line[match.end():].split()
+
+    value, pos = parse_literal(line, 0, True)
+    if pos == 0 or line[pos - 1] != '-':
+        raise ValueError("Missing ' - ' separator")
+    if type(value) == list and len(value) == 0 and line.lstrip()[0] != '[':
+        raise ValueError("Missing spans")
+    return normalise_spans(value), line[pos:].split()
+
+def iter_annotation_lines(filename):
+    """Yield (line number, spans, labels) for each item in a file, reading
+    one line at a time. Errors report the file and line."""
+    with open(filename) as src:
+        for line_no, line in enumerate(src, 1):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                spans, labels = parse_line(line)
+            except ValueError as e:
+                raise Exception("{}:{}: {}".format(filename, line_no, e))
+            yield line_no, spans, labels
+
+def format_line(spans, labels):
+    """The text form of an item, given its (start, end) span pairs."""
+    labels = ' '.join([str(label) for label in labels])
+
+    text = '[' + ', '.join([str(span) for span in spans]) +']'
+    if len(spans) == 1:
+        start, end = spans[0]
+        text = str(spans[0])
+        if start == end:
+            text = str(start)
+            if len(start) == 1:
+                text = str(start[0])
+    elif len(spans) > 1:
+        if all(start == end for start, end in spans):
+            text = str([start for start, _ in spans])
+            if len(spans[0][0]) == 1:
+                text = " ".join([str(start[0]) for start, _ in spans])
+
+    return "{} - {}".format(text, labels)
+
+# Binary annotation files hold the same items as text files, but in columns
+# that can be memory-mapped rather than parsed:
+#   header       magic, version, position length, item / span / label
+#                reference counts, and the size of the label dictionary
+#   typecodes    the array typecode of each column below
+#   item_spans   [items + 1], where each item's spans start
+#   positions    [spans] per position field, first for the span starts and
+#                then for the span ends
+#   item_labels  [items + 1], where each item's labels start
+#   label_refs   [label references], indices into the dictionary
+#   dictionary   UTF-8 labels separated by newlines
+# Each column uses the narrowest signed integer type that fits its values and
+# starts on an 8 byte boundary. All numbers are little-endian.
+
+BINARY_MAGIC = b'SLATEANN'
+BINARY_VERSION = 1
+BINARY_SUFFIX = '.bin'
+_HEADER = struct.Struct('<8sIIQQQQ')
+_TYPECODES = 'bhiq'
+
+def is_binary_file(filename):
+    with open(filename, 'rb') as src:
+        return src.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+def _padding(size):
+    return -size % 8
+
+def _narrowest(values):
+    low = min(values) if len(values) > 0 else 0
+    high = max(values) if len(values) > 0 else 0
+    for typecode in _TYPECODES:
+        limit = 2 ** (8 * array.array(typecode).itemsize - 1)
+        if -limit <= low and high < limit:
+            return array.array(typecode, values)
+    raise ValueError("Value out of range: {}".format((low, high)))
+
+def write_binary(filename, items):
+    """Write (spans, labels) items, where spans are (start, end) pairs."""
+    item_spans = [0]
+    item_labels = [0]
+    label_refs = []
+    label_ids = {}
+    columns = None
+    length = None
+    for spans, labels in items:
+        if columns is None and len(spans) > 0:
+            length = len(spans[0][0])
+            columns = [[] for _ in range(2 * length)]
+        for start, end in spans:
+            if len(start) != length or len(end) != length:
+                raise ValueError("All positions must have {} parts, got {}".format(length, (start, end)))
+            for column, value in zip(columns, start + end):
+                column.append(value)
+        item_spans.append(item_spans[-1] + len(spans))
+        for label in labels:
+            label_refs.append(label_ids.setdefault(label, len(label_ids)))
+        item_labels.append(len(label_refs))
+    if columns is None:
+        length = 0
+        columns = []
+
+    columns = [_narrowest(values) for values in [item_spans] + columns + [item_labels, label_refs]]
+    typecodes = ''.join([values.typecode for values in columns]).encode('ascii')
+    dictionary = '\n'.join(sorted(label_ids, key=label_ids.get)).encode('utf-8')
+    with open(filename, 'wb') as out:
+        out.write(_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, length,
+            len(item_spans) - 1, item_spans[-1], len(label_refs), len(dictionary)))
+        out.write(typecodes + b'\0' * _padding(_HEADER.size + len(typecodes)))
+        for values in columns:
+            if sys.byteorder != 'little':
+                values.byteswap()
+            values.tofile(out)
+            out.write(b'\0' * _padding(len(values) * values.itemsize))
+        out.write(dictionary)
+
+class BinaryAnnotations(object):
+    """Read-only access to a binary annotation file.
+
+    The file is memory-mapped and items are only decoded when accessed, so
+    opening a file takes the same time regardless of its size."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as src:
+            self.map = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, length, num_items, num_spans, num_refs, dictionary_size = \
+                _HEADER.unpack_from(self.map, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            self.map.close()
+            raise Exception("{} is not a version {} binary annotation file".format(filename, BINARY_VERSION))
+        self.length = length
+        self.num_items = num_items
+
+        num_columns = 2 * length + 3
+        offset = _HEADER.size
+        typecodes = self.map[offset:offset + num_columns].decode('ascii')
+        offset += num_columns + _padding(offset + num_columns)
+        counts = [num_items + 1] + [num_spans] * (2 * length) + [num_items + 1, num_refs]
+        columns = []
+        for typecode, count in zip(typecodes, counts):
+            size = array.array(typecode).itemsize * count
+            if offset + size > len(self.map):
+                self.map.close()
+                raise Exception("{} is truncated".format(filename))
+            if sys.byteorder == 'little':
+                values = memoryview(self.map)[offset:offset + size].cast(typecode)
+            else:
+                values = array.array(typecode, self.map[offset:offset + size])
+                values.byteswap()
+            columns.append(values)
+            offset += size + _padding(size)
+        self.item_spans = columns[0]
+        self.columns = columns[1:-2]
+        self.item_labels, self.label_refs = columns[-2:]
+        dictionary = self.map[offset:offset + dictionary_size].decode('utf-8')
+        # A dictionary holding only the empty label is itself empty
+        self.labels = dictionary.split('\n') if num_refs > 0 else []
+
+    def __len__(self):
+        return self.num_items
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_items
+        if not 0 <= index < self.num_items:
+            raise IndexError("Item {} out of range".format(index))
+        length = self.length
+        spans = []
+        for span in range(self.item_spans[index], self.item_spans[index + 1]):
+            values = tuple([column[span] for column in self.columns])
+            spans.append((values[:length], values[length:]))
+        labels = [self.labels[self.label_refs[ref]]
+                for ref in range(self.item_labels[index], self.item_labels[index + 1])]
+        return spans, labels
+
+    def __iter__(self):
+        for index in range(self.num_items):
+            yield self[index]
+
+    def close(self):
+        # Views into the map must be released before it can be closed
+        for values in [self.item_spans, self.item_labels, self.label_refs] + self.columns:
+            if isinstance(values, memoryview):
+                values.release()
+        self.columns = []
+        self.map.close()
+
+def _span_pairs(spans):
+    pairs = []
+    for span in spans:
+        if len(span) == 0 or type(span[0]) == int:
+            pairs.append((span, span))
+        else:
+            pairs.append((tuple(span[0]), tuple(span[1])))
+    return pairs
+
+def iter_annotations(filename):
+    """Yield (record number, spans, labels) for each item in a text or
+    binary annotation file. Spans are as written in text files."""
+    if is_binary_file(filename):
+        annotations = BinaryAnnotations(filename)
+        try:
+            for index, (spans, labels) in enumerate(annotations):
+                yield index + 1, spans, labels
+        finally:
+            annotations.close()
+    else:
+        for item in iter_annotation_lines(filename):
+            yield item
+
+# Model predictions are JSON lines files, one item per line, with the
+# model's confidence in it:
+#   {"spans": [[[3, 5], [3, 8]]], "label": "PER", "confidence": 0.42}
+# "spans" is either JSON lists or text in the annotation file format, and
+# "label" is left out for links. Other keys (e.g. "file") are ignored.
+PREDICTIONS_SUFFIX = '.jsonl'
+
+def _as_tuple(span):
+    # JSON gives lists, but spans are tuples of positions or of ints
+    if type(span) != list:
+        return span
+    if len(span) > 0 and type(span[0]) == list:
+        return tuple([tuple(pos) for pos in span])
+    return tuple(span)
+
+def json_spans(value):
+    """Spans from a JSON value, normalised as for annotation files."""
+    if type(value) == list:
+        value = [_as_tuple(span) for span in value]
+    elif type(value) != int:
+        value, _ = parse_literal(value)
+    return normalise_spans(value)
+
+def iter_predictions(filename):
+    """Yield (line number, spans, labels, confidence) for each prediction."""
+    for line_no, line in enumerate(open(filename), 1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            prediction = json.loads(line)
+            spans = json_spans(prediction['spans'])
+            label = prediction.get('label')
+            labels = [] if label is None else [label]
+            confidence = float(prediction['confidence'])
+        except (ValueError, KeyError, TypeError) as e:
+            raise Exception("{}:{}: {}".format(filename, line_no, e))
+        yield line_no, spans, labels, confidence
+
+def convert(src, dest, binary=None):
+    """Convert between text and binary annotation files. By default the
+    output is in the other format from the input."""
+    if binary is None:
+        binary = not is_binary_file(src)
+    items = ((_span_pairs(spans), labels) for _, spans, labels in iter_annotations(src))
+    if binary:
+        write_binary(dest, items)
+    else:
+        with open(dest, 'w') as out:
+            for spans, labels in items:
+                print(format_line(spans, labels), file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert slate annotation files between the text and binary formats.')
+    parser.add_argument('src', help='Annotation file to read (text or binary).')
+    parser.add_argument('dest', help='File to write.')
+    parser.add_argument('--to', choices=['text', 'binary'], help='Output format (default: the other format from the input).')
+    args = parser.parse_args()
+
+    binary = None if args.to is None else args.to == 'binary'
+    convert(args.src, args.dest, binary)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+from __future__ import print_function
+
+import io
+import json
+import logging
+import os
+import time
+import zlib
+
+from .fileformat import parse_line
+
+# A journal is kept beside each annotation file while it is being edited.
+# Every modify_annotation / remove_annotation call is appended to it before
+# it is applied, so an edit is never lost once it has been made, and the
+# annotation file itself only needs to be rewritten occasionally (when the
+# journal is compacted). Each line is one call, with the label as JSON so
+# that labels with spaces, and empty labels, are kept exactly:
+#   modify [(start, end), ...] - "label" (or null for no label)
+#   remove [(start, end), ...] - null
+# The first line records a checksum of the annotation file the edits apply
+# to. Once the annotation file has been rewritten the checksum no longer
+# matches, so a journal left behind by a crash during compaction is not
+# applied twice.
+
+HEADER = "# slate journal"
+
+def file_checksum(filename):
+    if not os.path.exists(filename):
+        return 'none'
+    crc = 0
+    with open(filename, 'rb') as src:
+        while True:
+            chunk = src.read(1 << 20)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return str(crc & 0xffffffff)
+
+def sync_file(out):
+    out.flush()
+    os.fsync(out.fileno())
+
+class Journal(object):
+    """Append-only log of the edits made to one annotation file.
+
+    Writes reach the operating system immediately and are forced to disk
+    once sync_every edits or sync_interval seconds have accumulated."""
+
+    def __init__(self, filename, base_file, sync_every=20, sync_interval=1.0, compact_every=500):
+        self.filename = filename
+        self.base_file = base_file
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.out = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.edits = 0
+        # Bytes of the journal holding complete edits
+        self.complete_size = 0
+        # The edits (and bytes) covered by the last save
+        self.saved_edits = 0
+        self.saved_size = 0
+
+    def pending(self):
+        """Edits left by a session that did not finish cleanly, as (action,
+        spans, label) tuples, where spans are (start, end) pairs and label is
+        None when there is none."""
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename, 'rb') as src:
+            lines = [line.decode('utf-8') for line in src.readlines()]
+        if len(lines) == 0 or not lines[0].startswith(HEADER):
+            logging.warning("Ignoring {}, it is not a journal".format(self.filename))
+            return []
+        checksum = lines[0][len(HEADER):].strip()
+        if checksum != file_checksum(self.base_file):
+            logging.warning("Ignoring {}, {} has changed since it was written".format(self.filename, self.base_file))
+            return []
+
+        edits = []
+        self.complete_size = len(lines[0].encode('utf-8'))
+        for line_no, line in enumerate(lines[1:], 2):
+            if not line.endswith('\n'):
+                # The write of the last edit was interrupted
+                logging.warning("Ignoring incomplete edit at {}:{}".format(self.filename, line_no))
+                break
+            action, _, rest = line.partition(' ')
+            spans, _, label = rest.partition(' - ')
+            try:
+                spans, _ = parse_line(spans + ' -')
+                label = json.loads(label)
+            except ValueError as e:
+                raise Exception("{}:{}: {}".format(self.filename, line_no, e))
+            if action not in ('modify', 'remove'):
+                raise Exception("{}:{}: Unknown action {}".format(self.filename, line_no, action))
+            edits.append((action, spans, label))
+            self.complete_size += len(line.encode('utf-8'))
+        self.edits = len(edits)
+        return edits
+
+    def open(self):
+        """Start appending, keeping any edits already in the journal."""
+        if os.path.exists(self.filename) and self.edits > 0:
+            self.out = io.open(self.filename, 'a', encoding='utf-8')
+            self.out.truncate(self.complete_size)
+            # Edits recovered from disk count as saved
+            self.saved_edits = self.edits
+            self.saved_size = self.complete_size
+        else:
+            self.reset()
+
+    def record(self, action, spans, label=None):
+        spans = '[' + ', '.join([str((span.start, span.end)) for span in spans]) + ']'
+        line = "{} {} - {}\n".format(action, spans, json.dumps(label))
+        self.out.write(line)
+        self.out.flush()
+        self.complete_size += len(line.encode('utf-8'))
+        self.edits += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.out is not None and self.unsynced > 0:
+            sync_file(self.out)
+            self.unsynced = 0
+            self.last_sync = time.time()
+
+    def mark_saved(self):
+        """Sync, and note that the edits so far have been saved."""
+        self.sync()
+        self.saved_edits = self.edits
+        self.saved_size = self.complete_size
+
+    def drop_unsaved(self):
+        """Remove the edits made since the last save."""
+        if self.out is not None and self.edits > self.saved_edits:
+            self.out.truncate(self.saved_size)
+            self.complete_size = self.saved_size
+            self.edits = self.saved_edits
+            self.unsynced += 1
+            self.sync()
+
+    def needs_compaction(self):
+        return self.edits >= self.compact_every
+
+    def reset(self):
+        """Start a new, empty journal for the current annotation file."""
+        if self.out is not None:
+            self.out.close()
+        self.out = io.open(self.filename, 'w', encoding='utf-8')
+        header = "{} {}\n".format(HEADER, file_checksum(self.base_file))
+        self.out.write(header)
+        sync_file(self.out)
+        self.complete_size = len(header.encode('utf-8'))
+        self.edits = 0
+        self.saved_edits = 0
+        self.saved_size = self.complete_size
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self, remove=False):
+        if self.out is not None:
+            self.sync()
+            self.out.close()
+            self.out = None
+        if remove and os.path.exists(self.filename):
+            os.remove(self.filename)
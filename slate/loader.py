@@ -0,0 +1,120 @@
+from __future__ import print_function
+
+import collections
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .data import Datum
+
+class DatumLoader(object):
+    """Provides the Datum for each entry in a file list.
+
+    The files either side of the one in use are built on a background thread
+    so that moving to them does not wait for reading, tokenising and
+    comparing. When a file is left its edits are written out on the same
+    thread, and it is kept until it no longer fits in memory_budget bytes,
+    so moving back to it is free. Work there is done in order, so a file is
+    never read while an earlier save of it is still in progress."""
+
+    def __init__(self, config, filenames, memory_budget=200 * 2 ** 20):
+        self.config = config
+        self.filenames = filenames
+        self.memory_budget = memory_budget
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # File number -> future for its Datum
+        self.prefetched = {}
+        # File number -> (Datum, estimated size), least recently used first
+        self.cache = collections.OrderedDict()
+        self.cache_size = 0
+        self.saves = []
+        # File number -> the last write of a cached Datum
+        self.writes = {}
+
+    def _build(self, index):
+        filename, _, output_file, annotation_files = self.filenames[index]
+        return Datum(filename, self.config, output_file, annotation_files)
+
+    def _check_saves(self):
+        # Raise any error from a finished save here rather than losing it
+        for future in [future for future in self.saves if future.done()]:
+            self.saves.remove(future)
+            future.result()
+        for index in [index for index, future in self.writes.items() if future.done()]:
+            self.writes.pop(index).result()
+
+    def prefetch(self, index):
+        if 0 <= index < len(self.filenames) and index not in self.prefetched and \
+                index not in self.cache:
+            self.prefetched[index] = self.executor.submit(self._build, index)
+
+    def load(self, index):
+        """The Datum for a file, then start preparing its neighbours."""
+        self._check_saves()
+        if index in self.cache:
+            datum, size = self.cache.pop(index)
+            self.cache_size -= size
+            # Wait until its edits are written out
+            if index in self.writes:
+                self.writes.pop(index).result()
+            logging.info("Using cached data for file {}".format(index))
+        else:
+            future = self.prefetched.pop(index, None)
+            if future is None:
+                future = self.executor.submit(self._build, index)
+            elif future.done():
+                logging.info("Using prefetched data for file {}".format(index))
+            datum = future.result()
+
+        for other in list(self.prefetched):
+            if abs(other - index) > 1:
+                self.prefetched.pop(other).cancel()
+        self.prefetch(index + 1)
+        self.prefetch(index - 1)
+        return datum
+
+    def release(self, index, datum):
+        """Write out the edits to a Datum that is no longer in use and keep
+        it, making room if needed."""
+        if datum.journal is not None:
+            self.writes[index] = self.executor.submit(self._write, datum)
+        size = datum.memory_size()
+        self.cache[index] = (datum, size)
+        self.cache_size += size
+        while self.cache_size > self.memory_budget:
+            _, (old, old_size) = self.cache.popitem(last=False)
+            self.cache_size -= old_size
+            self.save(old)
+
+    def _write(self, datum):
+        if datum.journal.edits > 0 or not os.path.exists(datum.output_file):
+            datum.write_out()
+
+    def _save(self, datum):
+        self._write(datum)
+        datum.close_journal()
+
+    def save(self, datum):
+        """Write out a Datum that is no longer being edited (if it has any
+        changes), then remove its journal."""
+        self._check_saves()
+        if datum.journal is not None:
+            self.saves.append(self.executor.submit(self._save, datum))
+
+    def close(self, save=True):
+        """Save everything that is cached (or with save=False, only what
+        was written out when it was left) and wait for saves to finish,
+        dropping any unused prefetches."""
+        for future in self.prefetched.values():
+            future.cancel()
+        self.prefetched = {}
+        for datum, _ in self.cache.values():
+            if save:
+                self.save(datum)
+            elif datum.journal is not None:
+                self.saves.append(self.executor.submit(datum.close_journal))
+        self.cache.clear()
+        self.cache_size = 0
+        self.executor.shutdown(wait=True)
+        self._check_saves()
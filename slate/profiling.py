@@ -0,0 +1,146 @@
+from __future__ import print_function
+
+import math
+import sys
+import time
+
+# The parts of handling a keypress, in the order they happen. Time is given
+# to a stage when it is marked as done, so each covers everything since the
+# previous mark.
+STAGES = [
+    'dispatch',  # Finding the action for the keys typed
+    'action',    # Doing the action
+    'markings',  # Working out the colour of each position (get_all_markings)
+    'layout',    # Working out which lines fit on the screen
+    'draw',      # Drawing into the frame buffer
+    'output',    # Sending changes to the terminal
+    'other',     # Anything after the last mark
+]
+
+# Upper bounds of histogram buckets, in milliseconds
+BUCKETS = [0.125 * 2 ** i for i in range(15)]
+
+if hasattr(sys, 'getallocatedblocks'):
+    allocated_blocks = sys.getallocatedblocks
+else:
+    allocated_blocks = lambda: 0
+
+def percentile(values, fraction):
+    """Nearest rank percentile of sorted values."""
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+class Profiler(object):
+    """Time spent in each stage of handling each keypress, per file.
+
+    Along with time, the change in the number of memory blocks Python has
+    allocated is recorded, which shows stages that create many objects and
+    keep them. Only keypresses are measured, not waiting for them."""
+
+    def __init__(self):
+        # (filename, stage) -> seconds for each keypress
+        self.times = {}
+        # (filename, stage) -> change in allocated blocks for each keypress
+        self.blocks = {}
+        # stage -> [seconds, blocks] for the keypress being handled
+        self.current = None
+        self.last_time = None
+        self.last_blocks = None
+
+    def start(self):
+        self.current = {}
+        self.last_blocks = allocated_blocks()
+        self.last_time = time.perf_counter()
+
+    def mark(self, stage):
+        """Give the time since the last mark to a stage."""
+        if self.current is None:
+            return
+        now = time.perf_counter()
+        blocks = allocated_blocks()
+        cur = self.current.get(stage)
+        if cur is None:
+            cur = self.current[stage] = [0.0, 0]
+        cur[0] += now - self.last_time
+        cur[1] += blocks - self.last_blocks
+        self.last_blocks = blocks
+        # Leave out the time taken to do this
+        self.last_time = time.perf_counter()
+
+    def finish(self, filename):
+        """The keypress has been handled and the screen drawn."""
+        if self.current is None:
+            return
+        self.mark('other')
+        total = [0.0, 0]
+        for stage, (seconds, blocks) in self.current.items():
+            self.times.setdefault((filename, stage), []).append(seconds)
+            self.blocks.setdefault((filename, stage), []).append(blocks)
+            total[0] += seconds
+            total[1] += blocks
+        self.times.setdefault((filename, 'total'), []).append(total[0])
+        self.blocks.setdefault((filename, 'total'), []).append(total[1])
+        self.current = None
+
+    def _summary(self, times, blocks, out):
+        print("  {:<10} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+            "stage", "keys", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms", "blocks"), file=out)
+        for stage in STAGES + ['total']:
+            if stage not in times:
+                continue
+            values = sorted(times[stage])
+            print("  {:<10} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f}".format(
+                stage, len(values), 1000 * sum(values) / len(values),
+                1000 * percentile(values, 0.5), 1000 * percentile(values, 0.9),
+                1000 * percentile(values, 0.99), 1000 * values[-1],
+                sum(blocks[stage]) / float(len(blocks[stage]))), file=out)
+
+    def _histogram(self, stage, values, out):
+        counts = [0] * (len(BUCKETS) + 1)
+        for value in values:
+            ms = value * 1000
+            bucket = 0
+            while bucket < len(BUCKETS) and ms >= BUCKETS[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+        most = max(counts)
+        print("  {}".format(stage), file=out)
+        for bucket, count in enumerate(counts):
+            if count == 0:
+                continue
+            if bucket == len(BUCKETS):
+                name = ">= {:g} ms".format(BUCKETS[-1])
+            else:
+                name = "< {:g} ms".format(BUCKETS[bucket])
+            print("    {:>14} {:>7} {}".format(name, count, '#' * max(1, 50 * count // most)), file=out)
+
+    def write(self, filename):
+        """Write a summary and histograms of the time for each stage, for
+        all files together and then for each file."""
+        files = sorted(set(name for name, _ in self.times))
+        all_times = {}
+        all_blocks = {}
+        for (_, stage), values in self.times.items():
+            all_times.setdefault(stage, []).extend(values)
+        for (_, stage), values in self.blocks.items():
+            all_blocks.setdefault(stage, []).extend(values)
+
+        out = open(filename, 'w')
+        print("Time for each keypress by stage. Blocks is the mean change in "
+                "memory blocks allocated.", file=out)
+        sections = [("All files", all_times, all_blocks)]
+        for name in files:
+            times = {stage: values for (cur, stage), values in self.times.items() if cur == name}
+            blocks = {stage: values for (cur, stage), values in self.blocks.items() if cur == name}
+            sections.append(("File: {}".format(name), times, blocks))
+        for title, times, blocks in sections:
+            if len(times) == 0:
+                continue
+            print("", file=out)
+            print(title, file=out)
+            self._summary(times, blocks, out)
+            print("", file=out)
+            print("  Histograms", file=out)
+            for stage in STAGES + ['total']:
+                if stage in times:
+                    self._histogram(stage, times[stage], out)
+        out.close()
@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import bisect
+
+from .adjudication import item_key, span_key
+
+def spans_key(spans):
+    return frozenset([span_key(span) for span in spans]), len(spans)
+
+class ReviewQueue(object):
+    """Model predictions in order of confidence, least confident first, so
+    that the ones the model is least sure of can be reviewed first.
+
+    A prediction counts as reviewed once the annotations have an item with
+    exactly its spans. The ranks of those that have not been reviewed are
+    kept sorted and updated as annotations change, so finding the next one
+    is a binary search."""
+
+    def __init__(self, annotations, predictions):
+        # predictions are (item, confidence) pairs
+        ranked = sorted(predictions, key=lambda prediction: (prediction[1], item_key(prediction[0])))
+        self.items = [item for item, _ in ranked]
+        self.confidences = [confidence for _, confidence in ranked]
+
+        # spans key -> ranks of predictions with exactly those spans
+        self.by_spans = {}
+        # (start, end) -> ranks of predictions with that span
+        self.by_span = {}
+        for rank, item in enumerate(self.items):
+            self.by_spans.setdefault(spans_key(item.spans), []).append(rank)
+            for span in item.spans:
+                self.by_span.setdefault(span_key(span), []).append(rank)
+
+        self.unreviewed = [rank for rank, item in enumerate(self.items)
+                if len(annotations.with_spans(item.spans)) == 0]
+        # The rank last moved to, so that predictions sharing a span are
+        # stepped through in order rather than always from the first
+        self.current = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def mark_reviewed(self, spans):
+        for rank in self.by_spans.get(spans_key(spans), ()):
+            index = bisect.bisect_left(self.unreviewed, rank)
+            if index < len(self.unreviewed) and self.unreviewed[index] == rank:
+                del self.unreviewed[index]
+
+    def mark_unreviewed(self, spans):
+        for rank in self.by_spans.get(spans_key(spans), ()):
+            index = bisect.bisect_left(self.unreviewed, rank)
+            if index == len(self.unreviewed) or self.unreviewed[index] != rank:
+                self.unreviewed.insert(index, rank)
+
+    def _target(self, rank, use_last):
+        spans = self.items[rank].spans
+        return max(spans) if use_last else min(spans)
+
+    def _origin(self, pos, use_last):
+        if self.current is not None and self._target(self.current, use_last) == pos:
+            return self.current
+        ranks = self.by_span.get(span_key(pos))
+        return None if ranks is None else ranks[0]
+
+    def next_prediction(self, pos, direction, use_last=False):
+        """The span to move to for the next (or previous) prediction that
+        has not been reviewed, in order of confidence, wrapping around at
+        the ends. Starting away from a prediction, next goes to the least
+        confident. For links, use_last gives the last span of the item,
+        otherwise the first."""
+        if len(self.unreviewed) == 0:
+            return None
+        origin = self._origin(pos, use_last)
+        if direction == 'next':
+            index = 0
+            if origin is not None:
+                index = bisect.bisect_right(self.unreviewed, origin)
+                if index == len(self.unreviewed):
+                    index = 0
+        else:
+            index = len(self.unreviewed) - 1
+            if origin is not None:
+                index = bisect.bisect_left(self.unreviewed, origin) - 1
+        self.current = self.unreviewed[index]
+        return self._target(self.current, use_last)
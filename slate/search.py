@@ -0,0 +1,217 @@
+from __future__ import print_function
+
+import array
+import bisect
+import collections
+import logging
+import re
+import sys
+
+class SearchIndex(object):
+    """Finds the positions of queries in a Document.
+
+    Queries are either plain text or regular expressions. Plain text queries
+    without whitespace are answered from an index of the document's tokens,
+    built the first time it is needed: the distinct tokens with a suffix
+    array over them, so the tokens containing a query are found by bisection,
+    and the token numbers where each one occurs. Other queries are run over
+    the text. As with str.split, matches do not overlap. Results are lists of
+    (line, token, character) positions in document order, and only the most
+    recent queries are kept."""
+
+    def __init__(self, doc, cache_size=32):
+        self.doc = doc
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        # The distinct tokens in order, joined by newlines (which are never
+        # in a token), and where each starts. Only for documents with a store.
+        self.vocabulary = None
+        self.vocabulary_starts = None
+        # Offsets in vocabulary of every suffix of every token, in order of
+        # the suffixes
+        self.suffixes = None
+        # For each distinct token, an array of the token numbers where it is
+        self.postings = None
+
+    def memory_size(self):
+        size = 0
+        if self.postings is not None:
+            size += sys.getsizeof(self.vocabulary)
+            for values in [self.vocabulary_starts, self.suffixes]:
+                size += values.itemsize * len(values)
+            for indices in self.postings:
+                size += indices.itemsize * len(indices) + 100
+        for positions in self.cache.values():
+            size += 72 * len(positions)
+        return size
+
+    def _build_postings(self):
+        store = self.doc.store
+        text = store.text
+        starts = store.token_starts
+        ends = store.token_ends
+        typecode = 'i' if store.total_tokens() < 2 ** 31 else 'q'
+        postings = {}
+        for index in range(store.total_tokens()):
+            token = text[starts[index]:ends[index]]
+            cur = postings.get(token)
+            if cur is None:
+                cur = array.array(typecode)
+                postings[token] = cur
+            cur.append(index)
+
+        tokens = sorted(postings)
+        vocabulary = '\n'.join(tokens) + '\n'
+        typecode = 'i' if len(vocabulary) < 2 ** 31 else 'q'
+        vocabulary_starts = array.array(typecode)
+        offset = 0
+        for token in tokens:
+            vocabulary_starts.append(offset)
+            offset += len(token) + 1
+        suffixes = [offset for offset in range(len(vocabulary)) if vocabulary[offset] != '\n']
+        suffixes.sort(key=self._suffix_getter(vocabulary))
+
+        self.vocabulary = vocabulary
+        self.vocabulary_starts = vocabulary_starts
+        self.suffixes = array.array(typecode, suffixes)
+        self.postings = [postings[token] for token in tokens]
+
+    @staticmethod
+    def _suffix_getter(vocabulary):
+        def suffix(offset):
+            return vocabulary[offset:vocabulary.index('\n', offset)]
+        return suffix
+
+    def _token_matches(self, query):
+        if self.postings is None:
+            self._build_postings()
+        suffix = self._suffix_getter(self.vocabulary)
+        suffixes = self.suffixes
+        length = len(query)
+
+        # The suffixes that start with the query are together, find them
+        lo, hi = 0, len(suffixes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if suffix(suffixes[mid])[:length] < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        first = lo
+        hi = len(suffixes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if suffix(suffixes[mid])[:length] == query:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # Distinct token -> characters where the query starts in it
+        found = {}
+        for offset in suffixes[first:lo]:
+            token = bisect.bisect_right(self.vocabulary_starts, offset) - 1
+            found.setdefault(token, []).append(offset - self.vocabulary_starts[token])
+
+        store = self.doc.store
+        positions = []
+        for token, chars in found.items():
+            chars.sort()
+            kept = []
+            for char in chars:
+                if len(kept) == 0 or char >= kept[-1] + length:
+                    kept.append(char)
+            for index in self.postings[token]:
+                pos = store.token_at(index)
+                for char in kept:
+                    positions.append(pos + (char,))
+        positions.sort()
+        return positions
+
+    def _text_matches(self, pattern):
+        store = self.doc.store
+        line_starts = store.line_starts
+        token_starts = store.token_starts
+        token_ends = store.token_ends
+        positions = []
+        for match in pattern.finditer(store.text):
+            offset = match.start()
+            line = bisect.bisect_right(store.line_offsets, offset) - 1
+            lo = line_starts[line]
+            hi = line_starts[line + 1]
+            index = bisect.bisect_right(token_starts, offset, lo, hi) - 1
+            if index < lo or offset >= token_ends[index]:
+                # Starts in whitespace, so use the next token on the line
+                index += 1
+                if index >= hi:
+                    continue
+                offset = token_starts[index]
+            positions.append((line, index - lo, offset - token_starts[index]))
+        return positions
+
+    def _line_matches(self, pattern):
+        positions = []
+        for line_no, line in enumerate(self.doc.lines):
+            if pattern.search(line) is None:
+                continue
+            tokens = [(m.start(), m.end()) for m in re.finditer(r'[^\s]+', line)]
+            token_starts = [start for start, _ in tokens]
+            for match in pattern.finditer(line):
+                offset = match.start()
+                index = bisect.bisect_right(token_starts, offset) - 1
+                if index < 0 or offset >= tokens[index][1]:
+                    # Starts in whitespace, so use the next token on the line
+                    index += 1
+                    if index >= len(tokens):
+                        continue
+                    offset = tokens[index][0]
+                positions.append((line_no, index, offset - tokens[index][0]))
+        return positions
+
+    def matches(self, query, regex=False):
+        """All positions where the query starts, in document order."""
+        key = (query, regex)
+        if key in self.cache:
+            positions = self.cache.pop(key)
+            self.cache[key] = positions
+            return positions
+
+        positions = []
+        pattern = None
+        if regex:
+            try:
+                pattern = re.compile(query)
+            except re.error as e:
+                logging.warn("Invalid search pattern {}: {}".format(query, e))
+        elif len(query) > 0:
+            if self.doc.store is not None and len(query.split()) == 1 and query == query.strip():
+                positions = self._token_matches(query)
+            else:
+                pattern = re.compile(re.escape(query))
+        if pattern is not None:
+            if self.doc.store is not None:
+                positions = self._text_matches(pattern)
+            else:
+                positions = self._line_matches(pattern)
+
+        self.cache[key] = positions
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return positions
+
+    def find(self, pos, query, direction, regex=False):
+        """The closest match after (or before) pos, compared only as far as
+        pos goes, so a match inside the current token (or line) is skipped.
+        Returns None if there is no such match."""
+        if len(pos) == 0:
+            return None
+        positions = self.matches(query, regex)
+        if direction == 'next':
+            probe = tuple(pos) if len(pos) == 3 else tuple(pos) + (float('inf'),)
+            index = bisect.bisect_right(positions, probe)
+            if index < len(positions):
+                return positions[index]
+        elif direction == 'previous':
+            index = bisect.bisect_left(positions, tuple(pos))
+            if index > 0:
+                return positions[index - 1]
+        return None
@@ -8,7 +8,208 @@ import sys
 import textwrap
 
 from .config import *
-from .data import Span, span_compare_ge, span_compare_le
+
+class Layout(object):
+    """Where each token of a document goes on screen, for a given width.
+
+    Lines are laid out the same way as in View.do_contents, and the result
+    for each line is cached until the width changes, so working out what is
+    visible from a given top line only touches the lines on screen."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.width = None
+        self.number_width = None
+        self.lines = {}
+
+    def set_width(self, width, number_width):
+        if (width, number_width) != (self.width, self.number_width):
+            self.width = width
+            self.number_width = number_width
+            self.lines = {}
+
+    def line(self, line_no):
+        """Returns ([(row, end_pos) for each token], number of rows used)."""
+        if line_no in self.lines:
+            return self.lines[line_no]
+
+        width = self.width
+        number_width = self.number_width
+        tokens = []
+        row = 0
+        column = number_width
+        for token_no, token in enumerate(self.doc.tokens[line_no]):
+            space_before = 1 if column > number_width else 0
+            wide_token = False
+            if column + len(token) + space_before > width:
+                if token_no != 0:
+                    column = 0
+                    row += 1
+                    space_before = 0
+                else:
+                    wide_token = True
+
+            end_pos = len(token) - 1
+            if wide_token:
+                end_pos = width - column - space_before - 1
+            tokens.append((row, end_pos))
+
+            for char in token:
+                if column >= width:
+                    column = 0
+                    row += 1
+                column += 1 + space_before
+                space_before = 0
+
+        ans = (tokens, row + 1)
+        self.lines[line_no] = ans
+        return ans
+
+    def last_visible(self, top, height):
+        """The last token that starts on screen, as a character position."""
+        last = None
+        row = 0
+        line_no = max(0, top)
+        while line_no < len(self.doc.tokens) and row < height:
+            tokens, nrows = self.line(line_no)
+            for token_no, (token_row, end_pos) in enumerate(tokens):
+                if row + token_row >= height:
+                    break
+                last = (line_no, token_no, end_pos)
+            row += nrows
+            line_no += 1
+        return last
+
+    def is_visible(self, span, top, height):
+        if max(0, top) >= len(self.doc.tokens):
+            return True
+        last = self.last_visible(top, height)
+        if last is None:
+            return True
+        start = self.doc.get_3tuple(span.start, True)
+        end = self.doc.get_3tuple(span.end, False)
+        if start < (max(0, top), 0, 0):
+            return False
+        return start < last or (start == last and end == last)
+
+    def scroll_to(self, span, top, height):
+        """The first top line, at or after top, that has the span visible."""
+        if self.is_visible(span, top, height):
+            return top
+
+        # Work back from the span to find the highest top that includes it.
+        start = self.doc.get_3tuple(span.start, True)
+        tokens, _ = self.line(start[0])
+        rows = 1
+        if len(tokens) > 0:
+            rows += tokens[min(start[1], len(tokens) - 1)][0]
+        new_top = start[0]
+        while new_top - 1 >= top and rows + self.line(new_top - 1)[1] <= height:
+            new_top -= 1
+            rows += self.line(new_top)[1]
+
+        while not self.is_visible(span, new_top, height):
+            new_top += 1
+        return new_top
+
+class FrameBuffer(object):
+    """Stands in for the curses window when drawing, and sends only what has
+    changed since the last frame to the screen.
+
+    Drawing calls (addstr, clear, getmaxyx) fill in a frame of (character,
+    attribute) cells, following curses' rules for where text goes. refresh
+    compares the frame with the previous one and writes each run of changed
+    cells that share an attribute with a single addstr, then updates the
+    terminal once with noutrefresh and doupdate. So moving the cursor one
+    token sends a handful of cells rather than the whole screen."""
+
+    def __init__(self, window):
+        self.window = window
+        self.height = None
+        self.width = None
+        # What is on the screen, as [characters, attributes] per row, or
+        # None when that is not known
+        self.shown = None
+        self.chars = []
+        self.attrs = []
+        self.cells_written = 0
+        self.clear()
+
+    def getmaxyx(self):
+        return self.window.getmaxyx()
+
+    def clear(self):
+        """Start a new, blank frame (the screen is not changed until
+        refresh)."""
+        height, width = self.window.getmaxyx()
+        if (height, width) != (self.height, self.width):
+            # After a resize the screen has to be redrawn in full
+            self.height, self.width = height, width
+            self.shown = None
+        self.chars = [[' '] * width for _ in range(height)]
+        self.attrs = [[0] * width for _ in range(height)]
+
+    def erase(self):
+        self.clear()
+
+    def addstr(self, row, column, text, attr=0):
+        if not (0 <= row < self.height and 0 <= column < self.width):
+            raise _curses.error("addstr() returned ERR")
+        # Text carries on to the next row, and it is an error to go past
+        # the bottom right corner (though what fits is still drawn).
+        while len(text) > 0:
+            part = text[:self.width - column]
+            self.chars[row][column:column + len(part)] = part
+            self.attrs[row][column:column + len(part)] = [attr] * len(part)
+            text = text[len(part):]
+            column += len(part)
+            if column == self.width:
+                column = 0
+                row += 1
+                if row == self.height:
+                    raise _curses.error("addstr() returned ERR")
+
+    def refresh(self):
+        if self.shown is None:
+            self.window.clear()
+            self.shown = [[[' '] * self.width, [0] * self.width] for _ in range(self.height)]
+
+        cells = 0
+        runs = 0
+        for row in range(self.height):
+            chars = self.chars[row]
+            attrs = self.attrs[row]
+            old_chars, old_attrs = self.shown[row]
+            if chars == old_chars and attrs == old_attrs:
+                continue
+            column = 0
+            while column < self.width:
+                if chars[column] == old_chars[column] and attrs[column] == old_attrs[column]:
+                    column += 1
+                    continue
+                # Extend the run while cells differ and share an attribute
+                attr = attrs[column]
+                end = column + 1
+                while end < self.width and attrs[end] == attr and \
+                        (chars[end] != old_chars[end] or attrs[end] != old_attrs[end]):
+                    end += 1
+                try:
+                    self.window.addstr(row, column, ''.join(chars[column:end]), attr)
+                except _curses.error:
+                    # Writing the bottom right corner reports an error,
+                    # but the character is drawn
+                    pass
+                cells += end - column
+                runs += 1
+                column = end
+            self.shown[row] = [chars, attrs]
+            self.chars[row] = list(chars)
+            self.attrs[row] = list(attrs)
+
+        self.cells_written = cells
+        logging.debug("Frame: wrote %s cells in %s runs", cells, runs)
+        self.window.noutrefresh()
+        curses.doupdate()
 
 class View(object):
     def __init__(self, window, cursor, linking_pos, datum, my_config, cnum, total_num, prev_view=None):
@@ -34,6 +235,11 @@ class View(object):
             self.line_numbers = prev_view.line_numbers
 
         self.last_moved_pos = cursor
+        self.layout = Layout(self.datum.doc)
+        # markings -> curses attribute, filled in by marking_to_color
+        self.colors = {}
+        # Set by the Annotator when timing keypresses
+        self.profiler = None
 
         if self.config.annotation_type == 'categorical':
             for label, info in self.config.labels.items():
@@ -153,17 +359,22 @@ class View(object):
         logging.debug("Search {} {} {} {} {}".format(query, direction, count, maxjump, move_link))
         new_pos = None
         if query is None:
-            if len(self.datum.disagreements) == 0:
-                new_pos = self.datum.get_next_unannotated(self.cursor, self.linking_pos, direction, move_link)
-                if new_pos == self.linking_pos or new_pos is None:
-                    new_pos = self.datum.get_next_self_link(self.cursor, self.linking_pos, direction, move_link)
-            else:
-                new_pos = self.datum.get_next_disagreement(self.cursor, self.linking_pos, direction, move_link)
+            # Model predictions are reviewed least confident first, then
+            # this falls back to disagreements / unannotated items
+            new_pos = self.datum.get_next_prediction(self.cursor, self.linking_pos, direction, move_link)
+            if new_pos is None:
+                if len(self.datum.disagreements) == 0:
+                    new_pos = self.datum.get_next_unannotated(self.cursor, self.linking_pos, direction, move_link)
+                    if new_pos == self.linking_pos or new_pos is None:
+                        new_pos = self.datum.get_next_self_link(self.cursor, self.linking_pos, direction, move_link)
+                else:
+                    new_pos = self.datum.get_next_disagreement(self.cursor, self.linking_pos, direction, move_link)
         else:
             mover = self.cursor
             if move_link:
                 mover = self.linking_pos
-            new_pos = mover.search(query, direction, count, maxjump)
+            new_pos = mover.search(query, direction, count, maxjump,
+                    self.config.args.search_regex)
 
         if new_pos is not None:
             if self._check_move_allowed(move_link, new_pos):
@@ -189,53 +400,58 @@ class View(object):
         self.cursor = self.linking_pos.edited('previous')
 
     def marking_to_color(self, marking):
+        # The same markings come up again and again, so each distinct one
+        # is only resolved once
+        color = self.colors.get(marking)
+        if color is None:
+            color = self._marking_to_color(marking)
+            self.colors[marking] = color
+        return color
+
+    def _marking_to_color(self, marking):
         name = DEFAULT_COLOR
         modifier = curses.A_BOLD
         has_link = False
         has_ref = False
         has_self_link = False
         for mark in marking:
-            if mark == 'cursor':
-                modifier += curses.A_UNDERLINE
-            elif mark == 'link':
-                has_link = True
-            elif mark == 'ref':
-                has_ref = True
-            elif mark == 'self-link':
-                has_self_link = True
-            elif mark == 'linked':
-                name = IS_LINKED_COLOR
-            elif mark in self.config.labels:
-                if name != DEFAULT_COLOR:
-                    name = OVERLAP_COLOR
-                else:
-                    name = self.config.get_color_for_label(mark)
-            elif mark.startswith("compare-"):
-                if 'ref' in mark:
-                    count = int(mark.split("-")[-2])
-                    if 'True' in mark and 'last' not in mark:
+            if type(mark) == tuple:
+                if mark[0] == 'compare-ref':
+                    _, linked, count, last = mark
+                    if linked and not last:
                         # First, cases where this is related to the current linking line
                         if name == DEFAULT_COLOR or name == COMPARE_DISAGREE_COLOR:
                             if count == 0:
                                 name = REF_COLOR
                             else:
                                 name = COMPARE_REF_COLOR
-                    elif count > 0 and 'last' in mark:
+                    elif count > 0 and last:
                         # If unrelated, but there is a disagreement, indicate it
                         if name == DEFAULT_COLOR:
                             name = COMPARE_DISAGREE_COLOR
                 else:
-                    count = int(mark.split("-")[-2])
+                    _, count, key = mark
                     if name == DEFAULT_COLOR:
                         if count == 0:
-                            key = mark.split("-")[-1]
                             if key in self.config.labels:
                                 name = self.config.get_color_for_label(key)
                         else:
                             name = COMPARE_DISAGREE_COLOR
-###                    key = mark.split("-")[-1]
-###                    if key in self.config.labels:
-###                        name = self.config.get_color_for_label(mark)
+            elif mark == 'cursor':
+                modifier += curses.A_UNDERLINE
+            elif mark == 'link':
+                has_link = True
+            elif mark == 'ref':
+                has_ref = True
+            elif mark == 'self-link':
+                has_self_link = True
+            elif mark == 'linked':
+                name = IS_LINKED_COLOR
+            elif mark in self.config.labels:
+                if name != DEFAULT_COLOR:
+                    name = OVERLAP_COLOR
+                else:
+                    name = self.config.get_color_for_label(mark)
         # Override cases
         if has_link:
             if has_ref:
@@ -250,29 +466,30 @@ class View(object):
 
         return curses.color_pair(name) + modifier
 
-    def do_contents(self, height, width, markings, number_width, trial=False):
+    def do_contents(self, height, width, markings, number_width):
         # For linked items, colour them to indicate it
         # For labels, colour them always, and add beginning / end
         # For freeform text, include it at the bottom
 
         # Row and column indicate the position on the screen, while line and
         # token indicate the position in the text.
-        first_span = None
-        last_span = None
         row = -1
-        for line_no, line in enumerate(self.datum.doc.tokens):
-            # If this line is above the top of what we are shwoing, skip it
-            if line_no < self.top:
-                continue
+        tokens = self.datum.doc.tokens
+        # Allow multiple layers of color, with the more specific dominating.
+        # Marks only go down to characters when annotating characters, so
+        # otherwise the color is worked out once per token.
+        char_marks = self.config.annotation == 'character'
+        doc_mark = markings.get((), ())
+        for line_no in range(max(0, self.top), len(tokens)):
+            line = tokens[line_no]
             if row >= height:
                 break
-            if first_span is None:
-                first_span = Span('character', self.datum.doc, (line_no, 0, 0))
+            line_mark = markings.get((line_no,), doc_mark)
 
             # Set
             row += 1
             column = number_width
-            if (not trial) and column > 0:
+            if column > 0:
                 if row < height:
                     self.window.addstr(row, 0, str(line_no), curses.color_pair(LINE_NUMBER_COLOR))
             for token_no, token in enumerate(line):
@@ -292,10 +509,21 @@ class View(object):
                 if row >= height:
                     break
 
-                end_pos = len(token) - 1
-                if wide_token:
-                    end_pos = width - column - space_before - 1
-                last_span = Span('character', self.datum.doc, (line_no, token_no, end_pos))
+                if space_before > 0:
+                    mark = markings.get((line_no, token_no, -1), line_mark)
+                    self.window.addstr(row, column, ' ', self.marking_to_color(mark))
+                    column += 1
+
+                token_mark = markings.get((line_no, token_no), line_mark)
+                color = self.marking_to_color(token_mark)
+                if column + len(token) <= width and not char_marks:
+                    # The whole token fits on this row in one color
+                    try:
+                        self.window.addstr(row, column, token, color)
+                    except _curses.error as e:
+                        logging.warn("Error caught in drawing extra lines 2")
+                    column += len(token)
+                    continue
 
                 for char_no, char in enumerate(token):
                     if column >= width:
@@ -304,58 +532,18 @@ class View(object):
                         if row >= height:
                             break
 
-                    # Allow multiple layers of color, with the more specific
-                    # domainating
-                    if space_before > 0:
-                        if not trial:
-                            mark = []
-                            if () in markings:
-                                mark = markings[()]
-                            if (line_no,) in markings:
-                                mark = markings[(line_no,)]
-                            if (line_no, token_no, -1) in markings:
-                                mark = markings[line_no, token_no, -1]
-                            color = self.marking_to_color(mark)
-                            self.window.addstr(row, column, ' ', color)
-                        column += 1
-                        space_before = 0
-
-                    color = self.marking_to_color([])
-
-                    if not trial:
-                        mark = []
-                        if () in markings:
-                            mark = markings[()]
-                        if (line_no,) in markings:
-                            mark = markings[(line_no,)]
-                        if (line_no, token_no) in markings:
-                            mark = markings[line_no, token_no]
-                        if (line_no, token_no, char_no) in markings:
-                            mark = markings[line_no, token_no, char_no]
+                    if char_marks:
+                        mark = markings.get((line_no, token_no, char_no), token_mark)
                         color = self.marking_to_color(mark)
-                        try:
-                            self.window.addstr(row, column, char, color)
-                        except _curses.error as e:
-                            logging.warn("Error caught in drawing extra lines 2")
+                    try:
+                        self.window.addstr(row, column, char, color)
+                    except _curses.error as e:
+                        logging.warn("Error caught in drawing extra lines 2")
                     column += 1
 
                 if row >= height:
                     break
 
-        # Tracks if we can see where we moved to
-        if self.config.annotation == 'document':
-            return True
-        seen_last_moved_pos = True
-        if first_span is not None and last_span is not None:
-            if self.last_moved_pos is not None:
-                cmp_first = self.last_moved_pos.compare(first_span)
-                cmp_last = self.last_moved_pos.compare(last_span)
-                seen_last_moved_pos = cmp_first in span_compare_ge and \
-                        cmp_last in span_compare_le
-                if cmp_last == 'cover_one':
-                    seen_last_moved_pos = True
-        return seen_last_moved_pos
-
 
     def render(self, current_search, current_typing):
         height, width = self.window.getmaxyx()
@@ -395,6 +583,8 @@ class View(object):
             matched = textwrap.wrap(' '.join(matched), width - 1)
             for line in matched:
                 extra_text_lines.append(line)
+        if self.profiler is not None:
+            self.profiler.mark('markings')
 
         # First, plan instructions
         main_height = height
@@ -427,9 +617,12 @@ class View(object):
             number_width = count + 1
             main_width -= number_width
 
-        # Do dry runs, shifting top down until the position is visible
-        while not self.do_contents(main_height, main_width, markings, number_width, True):
-            self.top += 1
+        # Shift top down until the position is visible
+        self.layout.set_width(main_width, number_width)
+        if self.config.annotation != 'document' and self.last_moved_pos is not None:
+            self.top = self.layout.scroll_to(self.last_moved_pos, self.top, main_height)
+        if self.profiler is not None:
+            self.profiler.mark('layout')
 
         # Next, draw contents
         self.do_contents(main_height, main_width, markings, number_width)
@@ -463,7 +656,11 @@ class View(object):
                     except _curses.error as e:
                         logging.warn("Error caught in drawing extra lines")
 
+        if self.profiler is not None:
+            self.profiler.mark('draw')
         self.window.refresh()
+        if self.profiler is not None:
+            self.profiler.mark('output')
 
     def render_help(self):
         self.window.clear()
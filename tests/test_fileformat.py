@@ -0,0 +1,47 @@
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slate.fileformat import BinaryAnnotations, write_binary
+
+class BinaryRoundTripTest(unittest.TestCase):
+    """Items written with write_binary read back the same."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'out.annotations.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, items):
+        write_binary(self.filename, items)
+        annotations = BinaryAnnotations(self.filename)
+        try:
+            return list(annotations)
+        finally:
+            annotations.close()
+
+    def test_only_empty_label(self):
+        items = [([((0, 1), (0, 1))], [''])]
+        self.assertEqual(self.round_trip(items), items)
+
+    def test_mixed_labels(self):
+        items = [
+            ([((0, 1), (0, 1))], ['', 'a']),
+            ([((0, 2), (2, 0)), ((3, 0), (3, 1))], []),
+            ([((4, 0), (4, 0))], ['a', 'b']),
+        ]
+        self.assertEqual(self.round_trip(items), items)
+
+    def test_no_items(self):
+        self.assertEqual(self.round_trip([]), [])
+
+if __name__ == '__main__':
+    unittest.main()
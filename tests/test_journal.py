@@ -0,0 +1,72 @@
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slate import data
+from slate.config import Config
+
+class JournalRecoveryTest(unittest.TestCase):
+    """Edits left in a journal by a session that ended without saving are
+    applied, labels and all, the next time the file is opened."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'doc.txt')
+        with open(self.filename, 'w') as out:
+            print("a b c", file=out)
+            print("d e f", file=out)
+        self.output_file = self.filename + '.annotations'
+        args = argparse.Namespace(ann_type='categorical', ann_scope='token',
+                config_file=None, lazy_load=False, overwrite=True,
+                do_not_show_linked=False)
+        self.config = Config(args, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_datum(self):
+        datum = data.Datum(self.filename, self.config, self.output_file, [])
+        datum.start_journal()
+        return datum
+
+    def crash(self, datum):
+        # Leave the journal behind, as a session killed part way would
+        datum.journal.close(False)
+        datum.journal = None
+
+    def labels(self, datum):
+        return sorted((item.spans[0].start, sorted(item.labels)) for item in datum.annotations)
+
+    def span(self, datum, pos):
+        return data.Span('token', datum.doc, (pos, pos))
+
+    def test_labels_with_spaces(self):
+        datum = self.open_datum()
+        datum.modify_annotation([self.span(datum, (0, 1))], 'foo bar')
+        datum.modify_annotation([self.span(datum, (1, 0))], 'single')
+        self.crash(datum)
+
+        recovered = self.open_datum()
+        self.assertEqual(self.labels(recovered), [((0, 1), ['foo bar']), ((1, 0), ['single'])])
+        recovered.close_journal()
+
+    def test_empty_label_and_removal(self):
+        datum = self.open_datum()
+        datum.modify_annotation([self.span(datum, (0, 0))], '')
+        datum.modify_annotation([self.span(datum, (0, 2))], 'x')
+        datum.remove_annotation([self.span(datum, (0, 2))])
+        self.crash(datum)
+
+        recovered = self.open_datum()
+        self.assertEqual(self.labels(recovered), [((0, 0), [''])])
+        recovered.close_journal()
+
+if __name__ == '__main__':
+    unittest.main()